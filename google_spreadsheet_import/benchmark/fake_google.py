@@ -0,0 +1,229 @@
+# Copyright 2019, Jarsa Sistemas, S.A. de C.V.
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+""" Local HTTP server that imitates the endpoints of Google used by the
+module, it serves synthetic spreadsheets so the imports can be measured
+without network access.
+
+Only the Python standard library is used, so it can also be started alone::
+
+    python fake_google.py --rows 100000 --columns 20 --port 8765
+"""
+
+import argparse
+import csv
+import io
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Columns that can be imported into res.partner, the rest are extra columns.
+BASE_COLUMNS = ['ref', 'name', 'email', 'comment']
+# Rows of CSV written to the socket at the same time.
+WRITE_ROWS = 1000
+
+
+class Dataset(object):
+    """ Synthetic spreadsheet, the values depend only on the position of the
+    cell so the same options always serve the same content.
+
+    :param rows: rows without the header
+    :param columns: columns of each row, at least the ones of BASE_COLUMNS
+    :param quoting: 'minimal' to quote only the values that need it, 'all' to
+        quote all the values like the Visualization API does, or 'heavy' to
+        also add commas, quotes and line breaks to the values
+    """
+
+    def __init__(self, rows=10000, columns=10, quoting='all'):
+        self.rows = rows
+        self.quoting = quoting
+        self.header = BASE_COLUMNS + [
+            'extra_%d' % index
+            for index in range(max(columns - len(BASE_COLUMNS), 0))]
+
+    def get_row(self, index):
+        name = 'Benchmark partner %d' % index
+        comment = 'Row %d of the benchmark' % index
+        if self.quoting == 'heavy':
+            name = 'Benchmark, "partner" %d' % index
+            comment = 'Row %d\nof the "benchmark", with commas' % index
+        row = [
+            'BENCH-%07d' % index,
+            name,
+            'partner%d@example.com' % index,
+            comment,
+        ]
+        row.extend(
+            'value %d-%d' % (index, column)
+            for column in range(len(self.header) - len(BASE_COLUMNS)))
+        return row
+
+    def iter_rows(self):
+        yield list(self.header)
+        for index in range(self.rows):
+            yield self.get_row(index)
+
+    def iter_csv(self):
+        """ Yields the CSV encoded in pieces of WRITE_ROWS rows. """
+        buffer = io.StringIO()
+        writer = csv.writer(
+            buffer, lineterminator='\n',
+            quoting=csv.QUOTE_MINIMAL if self.quoting == 'minimal' else (
+                csv.QUOTE_ALL))
+        for index, row in enumerate(self.iter_rows(), 1):
+            writer.writerow(row)
+            if index % WRITE_ROWS == 0:
+                yield buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode('utf-8')
+
+
+class FakeGoogleHandler(BaseHTTPRequestHandler):
+    """ Answers the requests of the Visualization API (gviz), the Sheets API
+    v4 and the files endpoint of the Drive API v3. """
+
+    def log_message(self, format, *args):
+        # pylint: disable=redefined-builtin
+        pass
+
+    def _send_json(self, values, status=200):
+        body = json.dumps(values).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.stats['bytes'] += len(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _get_metadata(self, id_file, values=None):
+        values = values or {}
+        return {
+            'spreadsheetId': id_file,
+            'spreadsheetUrl': 'http://%s:%s/spreadsheets/d/%s/edit' % (
+                self.server.server_address[0], self.server.server_address[1],
+                id_file),
+            'properties': values.get('properties', {'title': id_file}),
+            'sheets': values.get('sheets', [{
+                'properties': {'sheetId': 0, 'title': 'Sheet1', 'index': 0},
+            }]),
+        }
+
+    def do_GET(self):
+        self.server.count_request()
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        query = parse_qs(url.query)
+        if parts[:2] == ['spreadsheets', 'd'] and parts[3:] == [
+                'gviz', 'tq']:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv; charset=utf-8')
+            self.end_headers()
+            for chunk in self.server.dataset.iter_csv():
+                self.wfile.write(chunk)
+                self.server.stats['bytes'] += len(chunk)
+            return
+        if parts[:2] == ['v4', 'spreadsheets'] and len(parts) == 3:
+            self._send_json(self._get_metadata(parts[2]))
+            return
+        if parts[:2] == ['v4', 'spreadsheets'] and parts[3:] == [
+                'values:batchGet']:
+            values = list(self.server.dataset.iter_rows())
+            self._send_json({
+                'spreadsheetId': parts[2],
+                'valueRanges': [{
+                    'range': sheet_range,
+                    'majorDimension': 'ROWS',
+                    'values': values,
+                } for sheet_range in query.get('ranges', [])],
+            })
+            return
+        if parts[:3] == ['drive', 'v3', 'files'] and len(parts) == 4:
+            self._send_json({
+                'version': '1',
+                'modifiedTime': '2020-01-01T00:00:00.000Z',
+            })
+            return
+        self._send_json({'error': {'code': 404}}, status=404)
+
+    def do_POST(self):
+        self.server.count_request()
+        parts = urlparse(self.path).path.strip('/').split('/')
+        values = self._read_json()
+        if parts == ['v4', 'spreadsheets']:
+            self._send_json(self._get_metadata(
+                'bench-created-%d' % self.server.stats['requests'], values))
+            return
+        if parts[:2] == ['v4', 'spreadsheets'] and len(parts) in (3, 4):
+            # values:batchUpdate and batchUpdate
+            self._send_json({'spreadsheetId': parts[2].split(':')[0]})
+            return
+        self._send_json({'error': {'code': 404}}, status=404)
+
+
+class FakeGoogleServer(ThreadingHTTPServer):
+    """ Fake Google server running in a thread of the current process.
+
+    Usage::
+
+        with FakeGoogleServer(Dataset(rows=50000)) as server:
+            server.url  # http://127.0.0.1:<port>/
+    """
+    daemon_threads = True
+
+    def __init__(self, dataset, host='127.0.0.1', port=0):
+        super().__init__((host, port), FakeGoogleHandler)
+        self.dataset = dataset
+        self.stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'bytes': 0}
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s/' % self.server_address[:2]
+
+    def count_request(self):
+        with self.stats_lock:
+            self.stats['requests'] += 1
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.serve_forever, name='fake-google', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--columns', type=int, default=10)
+    parser.add_argument(
+        '--quoting', choices=['minimal', 'all', 'heavy'], default='all')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    server = FakeGoogleServer(
+        Dataset(args.rows, args.columns, args.quoting), port=args.port)
+    print('Serving the fake Google endpoints on %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+# Copyright 2019, Jarsa Sistemas, S.A. de C.V.
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+""" Benchmark of the imports of the module against a local fake Google
+server. Every scenario runs in a savepoint that is rolled back, nothing is
+saved in the database except the messages of ir.logging.
+
+From the command line (the database must have the module installed)::
+
+    python google_spreadsheet_import/benchmark/run.py -c odoo.conf \\
+        -d bench --rows 50000 --output bench_output.txt
+
+Or from an Odoo shell::
+
+    from odoo.addons.google_spreadsheet_import.benchmark import run
+    run.run(env, rows=50000)
+
+Each result is appended as a JSON line to the output file with the commit of
+the repository, so the results of different commits can be compared.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SCENARIOS = [
+    'native_gviz',
+    'native_batch',
+    'code',
+    'code_compact',
+    'code_stream',
+    'background_native',
+    'background_code',
+    'create_update_file',
+]
+# Code of the code imports, it only uses records, so it works with all the
+# types of records.
+BENCHMARK_CODE = """
+values = []
+for row in records:
+    values.append({
+        'name': row['name'],
+        'ref': row['ref'],
+        'email': row['email'],
+        'comment': row['comment'],
+    })
+    if len(values) >= 500:
+        model.create(values)
+        values = []
+if values:
+    model.create(values)
+"""
+# Models of the spreadsheet created by create_update_file.
+CREATE_MODELS = [
+    'res.partner', 'res.partner.bank', 'res.partner.category', 'res.users',
+    'res.company', 'res.currency',
+]
+
+
+def _get_peak_memory():
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+@contextmanager
+def fake_google(env, server):
+    """ Sends the requests of the module to the fake server, with an access
+    token that is never renewed and without the rate limit of Google. """
+    from odoo.addons.google_spreadsheet_import.models import (
+        google_client, google_spreadsheet_file)
+    endpoints = (
+        google_client.GVIZ_URL, google_client.DRIVE_FILES_URL,
+        google_client.SHEETS_API_ENDPOINT, google_client.rate_limiter)
+    key = env['google.spreadsheet.file']._get_access_token_key()
+    google_client.GVIZ_URL = server.url + 'spreadsheets/d/%s/gviz/tq'
+    google_client.DRIVE_FILES_URL = server.url + 'drive/v3/files/%s'
+    google_client.SHEETS_API_ENDPOINT = server.url
+    google_client.rate_limiter = google_client.TokenBucket(1e9, 1e9)
+    with google_spreadsheet_file._access_tokens_lock:
+        # The services are cached by token, a new token per server makes
+        # them use its endpoint.
+        google_spreadsheet_file._access_tokens[key] = (
+            'benchmark-%s' % server.server_address[1],
+            time.monotonic() + 24 * 3600)
+    try:
+        yield
+    finally:
+        (google_client.GVIZ_URL, google_client.DRIVE_FILES_URL,
+         google_client.SHEETS_API_ENDPOINT,
+         google_client.rate_limiter) = endpoints
+        with google_spreadsheet_file._access_tokens_lock:
+            google_spreadsheet_file._access_tokens.pop(key, None)
+
+
+@contextmanager
+def rollback(env):
+    """ Discards all the changes made inside it. """
+    env['base'].flush()
+    env.cr.execute('SAVEPOINT google_spreadsheet_benchmark')
+    try:
+        yield
+    finally:
+        env.clear()
+        env.cr.execute('ROLLBACK TO SAVEPOINT google_spreadsheet_benchmark')
+        env.cr.execute('RELEASE SAVEPOINT google_spreadsheet_benchmark')
+
+
+def _create_sheet(env, batch_size, **values):
+    spreadsheet_file = env['google.spreadsheet.file'].create({
+        'name': 'Benchmark',
+        'id_file': 'benchmark',
+    })
+    spreadsheet_file.get_file_info()
+    return env['google.spreadsheet'].create(dict({
+        'name': 'Benchmark',
+        'model_id': env['ir.model']._get_id('res.partner'),
+        'file_id': spreadsheet_file.id,
+        'batch_size': batch_size,
+    }, **values))
+
+
+def _run_background(sheet):
+    sheet.activate_background_import()
+    while sheet.background_import:
+        sheet.upload()
+
+
+def _prepare_scenario(env, scenario, batch_size):
+    """ Returns the function measured by the scenario. """
+    code = {'import_type': 'code', 'code': BENCHMARK_CODE}
+    if scenario == 'native_gviz':
+        return _create_sheet(env, batch_size).upload
+    if scenario == 'native_batch':
+        return _create_sheet(env, batch_size, fetch_mode='batch').upload
+    if scenario == 'code':
+        return _create_sheet(env, batch_size, **code).upload
+    if scenario == 'code_compact':
+        return _create_sheet(
+            env, batch_size, compact_records=True, **code).upload
+    if scenario == 'code_stream':
+        return _create_sheet(
+            env, batch_size, stream_records=True, **code).upload
+    if scenario == 'background_native':
+        sheet = _create_sheet(env, batch_size)
+        return lambda: _run_background(sheet)
+    if scenario == 'background_code':
+        sheet = _create_sheet(env, batch_size, **code)
+        return lambda: _run_background(sheet)
+    if scenario == 'create_update_file':
+        spreadsheet_file = env['google.spreadsheet.file'].create({
+            'name': 'Benchmark',
+            'file_type': 'create',
+            'model_ids': [(0, 0, {
+                'model_id': env['ir.model']._get_id(model),
+            }) for model in CREATE_MODELS if model in env],
+        })
+        return spreadsheet_file.create_update_file
+    raise ValueError('Unknown scenario %s' % scenario)
+
+
+def run(env, rows=10000, columns=10, quoting='all', batch_size=500,
+        scenarios=None, output=None):
+    """ Runs the scenarios and returns their results.
+
+    :param rows: rows of the spreadsheet without the header
+    :param columns: columns of the spreadsheet
+    :param quoting: quoting of the CSV, see fake_google.Dataset
+    :param batch_size: batch size of the sheets
+    :param scenarios: names of SCENARIOS to run, all by default
+    :param output: path of the file where the results are appended
+    """
+    from odoo.addons.google_spreadsheet_import.benchmark.fake_google import (
+        Dataset, FakeGoogleServer)
+    results = []
+    commit = _get_commit()
+    dataset = Dataset(rows=rows, columns=columns, quoting=quoting)
+    with FakeGoogleServer(dataset) as server, fake_google(env, server):
+        for scenario in scenarios or SCENARIOS:
+            with rollback(env):
+                func = _prepare_scenario(env, scenario, batch_size)
+                env['base'].flush()
+                requests = server.stats['requests']
+                sent = server.stats['bytes']
+                queries = getattr(env.cr, 'sql_log_count', 0)
+                memory = _get_peak_memory()
+                time_start = time.perf_counter()
+                func()
+                env['base'].flush()
+                seconds = time.perf_counter() - time_start
+                processed = (
+                    len(CREATE_MODELS) if scenario == 'create_update_file'
+                    else rows)
+                results.append({
+                    'commit': commit,
+                    'date': datetime.datetime.utcnow().isoformat(),
+                    'scenario': scenario,
+                    'rows': processed,
+                    'columns': columns,
+                    'quoting': quoting,
+                    'batch_size': batch_size,
+                    'seconds': round(seconds, 3),
+                    'rows_per_second': round(
+                        processed / seconds if seconds else 0.0, 1),
+                    'queries': getattr(env.cr, 'sql_log_count', 0) - queries,
+                    'requests': server.stats['requests'] - requests,
+                    'bytes': server.stats['bytes'] - sent,
+                    'peak_memory_delta_kb': _get_peak_memory() - memory,
+                })
+            _print_result(results[-1])
+    if output:
+        with open(output, 'a') as output_file:
+            for result in results:
+                output_file.write(json.dumps(result) + '\n')
+    return results
+
+
+def _print_result(result):
+    print(
+        '%(scenario)-20s %(rows)8d rows %(seconds)9.3fs '
+        '%(rows_per_second)10.1f rows/s %(queries)8d queries '
+        '%(requests)4d requests %(peak_memory_delta_kb)8d KB' % result)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--config', help='Odoo configuration file')
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--columns', type=int, default=10)
+    parser.add_argument(
+        '--quoting', choices=['minimal', 'all', 'heavy'], default='all')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument(
+        '--scenario', action='append', choices=SCENARIOS, dest='scenarios',
+        help='Scenario to run, it can be repeated. All by default.')
+    parser.add_argument('--output', default='bench_output.txt')
+    args = parser.parse_args()
+
+    import odoo
+    odoo_args = ['-d', args.database]
+    if args.config:
+        odoo_args += ['-c', args.config]
+    odoo.tools.config.parse_config(odoo_args)
+    odoo.modules.module.initialize_sys_path()
+    registry = odoo.registry(args.database)
+    with registry.cursor() as cr:
+        env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+        run(env, rows=args.rows, columns=args.columns, quoting=args.quoting,
+            batch_size=args.batch_size, scenarios=args.scenarios,
+            output=args.output)
+        cr.rollback()
+
+
+if __name__ == '__main__':
+    main()
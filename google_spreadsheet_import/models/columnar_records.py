@@ -0,0 +1,99 @@
+# Copyright 2019, Jarsa Sistemas, S.A. de C.V.
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import sys
+from collections.abc import Mapping
+
+
+class ColumnarRecords(object):
+    """ Rows of a spreadsheet stored as one list per column. The headers and
+    the values are interned, so repeated values are stored only once, and
+    the rows are returned as lightweight views that behave like the
+    dictionaries returned by csv.DictReader.
+    """
+    __slots__ = ('fieldnames', 'index', 'columns', 'length')
+
+    def __init__(self, fieldnames):
+        self.fieldnames = []
+        self.index = {}
+        self.columns = []
+        self.length = 0
+        for name in fieldnames or []:
+            self.add_column(name)
+
+    def add_column(self, name):
+        """ Adds an empty column and returns its position. """
+        if isinstance(name, str):
+            name = sys.intern(name)
+        self.index[name] = len(self.fieldnames)
+        self.fieldnames.append(name)
+        self.columns.append([None] * self.length)
+        return self.index[name]
+
+    def append(self, row):
+        """ Adds a row, it can be a mapping or a sequence of values in the
+        order of the columns. Missing values are saved as None. """
+        if isinstance(row, Mapping):
+            values = [row.get(name) for name in self.fieldnames]
+        else:
+            values = list(row[:len(self.columns)])
+            values += [None] * (len(self.columns) - len(values))
+        for column, value in zip(self.columns, values):
+            if isinstance(value, str):
+                value = sys.intern(value)
+            column.append(value)
+        self.length += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for position in range(self.length):
+            yield RecordView(self, position)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [
+                RecordView(self, index)
+                for index in range(*position.indices(self.length))]
+        if position < 0:
+            position += self.length
+        if not 0 <= position < self.length:
+            raise IndexError('record index out of range')
+        return RecordView(self, position)
+
+    def __repr__(self):
+        return '<ColumnarRecords columns=%s rows=%s>' % (
+            len(self.fieldnames), self.length)
+
+
+class RecordView(Mapping):
+    """ A row of ColumnarRecords, it reads and writes the values directly in
+    the columns. Assigning a key that does not exist adds a new column. """
+    __slots__ = ('records', 'position')
+
+    def __init__(self, records, position):
+        self.records = records
+        self.position = position
+
+    def __getitem__(self, key):
+        return self.records.columns[self.records.index[key]][self.position]
+
+    def __setitem__(self, key, value):
+        column = self.records.index.get(key)
+        if column is None:
+            column = self.records.add_column(key)
+        self.records.columns[column][self.position] = value
+
+    def __iter__(self):
+        return iter(self.records.fieldnames)
+
+    def __len__(self):
+        return len(self.records.fieldnames)
+
+    def __repr__(self):
+        return repr(dict(self))
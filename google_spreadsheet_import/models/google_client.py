@@ -0,0 +1,198 @@
+# Copyright 2019, Jarsa Sistemas, S.A. de C.V.
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+# pylint: disable=W7936
+
+import email.utils
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from googleapiclient import discovery
+from googleapiclient.errors import HttpError
+import google.oauth2.credentials
+import requests
+from requests.adapters import HTTPAdapter
+
+_logger = logging.getLogger(__name__)
+
+# Endpoints of Google, they can be changed to use a local server that
+# imitates them, like the one of the benchmarks.
+GVIZ_URL = 'https://docs.google.com/spreadsheets/d/%s/gviz/tq'
+DRIVE_FILES_URL = 'https://www.googleapis.com/drive/v3/files/%s'
+SHEETS_API_ENDPOINT = 'https://sheets.googleapis.com/'
+# Connections kept alive by the shared HTTP session for each host.
+HTTP_POOL_SIZE = 10
+# Requests per minute allowed by the default read quota of the Sheets API
+# for each user.
+REQUESTS_PER_MINUTE = 60
+# Requests that can be sent at once before the rate limit is applied.
+REQUESTS_BURST = 10
+# Requests to the same file that can be running at the same time.
+MAX_REQUESTS_PER_FILE = 2
+# Status codes of Google that are retried.
+RETRY_STATUS = (429, 500, 502, 503, 504)
+MAX_RETRIES = 5
+# Seconds waited before the first retry, it is doubled on each retry.
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 64.0
+
+_http_session = None
+_http_session_lock = threading.Lock()
+# Sheets API clients by access token. httplib2 is not thread safe, so each
+# thread keeps its own client.
+_services = threading.local()
+_file_semaphores = {}
+_file_semaphores_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """ Rate limiter shared by the threads of the process. Each request takes
+    a token, the tokens are refilled at a constant rate up to the capacity.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Takes a token, waiting until one is available.
+
+        :returns: seconds waited
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+rate_limiter = TokenBucket(REQUESTS_PER_MINUTE / 60.0, REQUESTS_BURST)
+
+
+def get_http_session():
+    """ Returns the requests session shared by the process, it keeps the
+    connections to Google alive between requests and threads. """
+    global _http_session  # pylint: disable=global-statement
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE,
+                pool_maxsize=HTTP_POOL_SIZE))
+            _http_session = session
+    return _http_session
+
+
+def get_sheets_service(access_token):
+    """ Returns the Sheets API client of the access token for the current
+    thread. It is built with the discovery document bundled in
+    googleapiclient and reused until the token changes. """
+    services = getattr(_services, 'by_token', {})
+    if access_token not in services:
+        credentials = google.oauth2.credentials.Credentials(access_token)
+        _services.by_token = services = {
+            access_token: discovery.build(
+                'sheets', 'v4', credentials=credentials,
+                cache_discovery=False, static_discovery=True,
+                client_options={'api_endpoint': SHEETS_API_ENDPOINT}),
+        }
+    return services[access_token]
+
+
+@contextmanager
+def _file_semaphore(id_file):
+    if not id_file:
+        yield
+        return
+    with _file_semaphores_lock:
+        semaphore = _file_semaphores.setdefault(
+            id_file, threading.BoundedSemaphore(MAX_REQUESTS_PER_FILE))
+    with semaphore:
+        yield
+
+
+def _get_retry_after(value):
+    """ Returns the seconds of a Retry-After header, it can be a number of
+    seconds or a date. """
+    if not value:
+        return 0.0
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+def _get_retry_delay(attempt, retry_after=None):
+    """ Returns the seconds to wait before a retry, the exponential backoff
+    has a random jitter so the threads do not retry at the same time. The
+    Retry-After header is respected up to BACKOFF_MAX, so a long value does
+    not block the worker and its transaction for hours. """
+    backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    backoff = backoff / 2 + random.uniform(0, backoff / 2)
+    return min(max(backoff, _get_retry_after(retry_after)), BACKOFF_MAX)
+
+
+def call(func, id_file=False, stats=None, retry_status=RETRY_STATUS):
+    """ Calls a Google API respecting the rate limit of the process and the
+    concurrency limit of the file, and retries it with exponential backoff
+    when Google answers with a status in retry_status or the connection
+    fails.
+
+    :param func: function without arguments that returns a requests
+        response, or that executes a googleapiclient request and raises
+        HttpError when it fails
+    :param id_file: ID of the spreadsheet used to limit the requests to the
+        same file
+    :param stats: dictionary updated with the number of retries and the
+        seconds waited by the rate limit and the retries
+    :returns: the result of func, the last response is returned (or the last
+        error raised) when all the retries fail
+    """
+    if stats is None:
+        stats = {}
+    stats.setdefault('retries', 0)
+    stats.setdefault('wait', 0.0)
+    for attempt in range(MAX_RETRIES + 1):
+        stats['wait'] += rate_limiter.acquire()
+        last_attempt = attempt == MAX_RETRIES
+        with _file_semaphore(id_file):
+            try:
+                response = func()
+            except HttpError as error:
+                if error.resp.status not in retry_status or last_attempt:
+                    raise
+                status = error.resp.status
+                retry_after = error.resp.get('retry-after')
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if last_attempt:
+                    raise
+                status = error.__class__.__name__
+                retry_after = None
+            else:
+                status = getattr(response, 'status_code', 200)
+                if status not in retry_status or last_attempt:
+                    return response
+                retry_after = response.headers.get('Retry-After')
+                response.close()
+        delay = _get_retry_delay(attempt, retry_after)
+        _logger.info(
+            'Google answered %s for the file %s, retrying in %.1f seconds '
+            '(%d/%d).', status, id_file, delay, attempt + 1, MAX_RETRIES)
+        stats['retries'] += 1
+        stats['wait'] += delay
+        time.sleep(delay)
@@ -5,17 +5,41 @@
 # pylint: disable=too-complex
 # pylint: disable=missing-manifest-dependency
 
+import codecs
+import cProfile
+import csv
+import hashlib
 import logging
-from csv import DictReader
+import pstats
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import StringIO
+from itertools import groupby, islice
 from pytz import timezone
 import datetime
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
 
-import requests
 from odoo import _, api, fields, models
-from odoo.exceptions import ValidationError, Warning
-from odoo.tools.safe_eval import safe_eval, test_python_expr, wrap_module
+from odoo.exceptions import (
+    RedirectWarning, UserError, ValidationError, Warning)
+from odoo.tools.safe_eval import (
+    _BUILTINS, _SAFE_OPCODES, check_values, safe_eval, test_expr,
+    test_python_expr, wrap_module)
+from odoo.http import AuthenticationError
+from psycopg2 import OperationalError
+import werkzeug.exceptions
+from psycopg2.extras import execute_values
 from odoo import tools
+from odoo.addons.base_import.models.base_import import ImportValidationError
+from googleapiclient.errors import HttpError
+from . import google_client
+from .columnar_records import ColumnarRecords
 
 _logger = logging.getLogger(__name__)
 
@@ -27,6 +51,35 @@ re = wrap_module(__import__('re'), [
     'match', 'findall', 'compile', 'search', 'finditer'])
 requests2 = wrap_module(__import__('requests'), ['get'])
 
+# Characters removed from the numbers before checking them, like the currency
+# symbols and the spaces.
+NUMBER_CLEAN_RE = re.compile(r'[^\d\-+.,eE()]')
+
+# Size of the pieces read from the HTTP response while downloading a sheet.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Seconds to wait for the connection and for each piece of the download.
+DOWNLOAD_TIMEOUT = (10, 300)
+# Spooled downloads are kept in memory up to this size, then moved to disk.
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+# Messages of log() in code imports are saved when the buffer has this size.
+LOG_BUFFER_SIZE = 500
+# Maximum number of values kept by lookup() in code imports.
+LOOKUP_CACHE_SIZE = 10000
+# Functions and queries shown in the profile reports of code imports.
+PROFILE_TOP_FUNCTIONS = 50
+PROFILE_TOP_QUERIES = 20
+
+# Exceptions raised as they are by safe_eval of Odoo 15.0, the rest are
+# wrapped in a ValueError. Keep it in sync with odoo/tools/safe_eval.py when
+# upgrading.
+SAFE_EVAL_RERAISE = (
+    UserError, RedirectWarning, werkzeug.exceptions.HTTPException,
+    AuthenticationError, OperationalError, ZeroDivisionError)
+
+# Code of the sheets compiled and checked by safe_eval, by database and sheet
+# id, with the hash of the code compiled.
+_compiled_codes = {}
+
 
 class GoogleDriveSheet(models.Model):
     _name = 'google.spreadsheet'
@@ -40,7 +93,13 @@ class GoogleDriveSheet(models.Model):
             '# To create a External ID use this code:'
             'create_external_id(record, xml_id)\n'
             '# To log a new error in this record, use this code: log_error('
-            'message, field=False, record=False,type=\'error\')')
+            'message, field=False, record=False,type=\'error\')\n'
+            '# To get many records by External ID with a single query: '
+            'get_external_ids(xml_ids)\n'
+            '# To create many External IDs at once: '
+            'create_external_ids([(record, xml_id), ...])\n'
+            '# To save the rows imported so far with Stream records: '
+            'commit()')
         return code
 
     name = fields.Char(required=True)
@@ -63,9 +122,45 @@ class GoogleDriveSheet(models.Model):
         "Example: select A, B, (D+E) where C < 100 and X = 'yes'\n"
         "For more information visit:\n"
         "https://developers.google.com/chart/interactive/docs/querylanguage")
+    fetch_mode = fields.Selection([
+        ('gviz', 'Visualization API'),
+        ('batch', 'Sheets API (one request per file)')],
+        default='gviz', required=True,
+        help='Visualization API: Each sheet is downloaded with its own '
+        'request.\n'
+        'Sheets API: All the sheets of the same file that are uploaded '
+        'together are downloaded with a single request. The query and the '
+        'header fix are not supported, sheets with a query use the '
+        'Visualization API.')
     error_ids = fields.One2many(
         'google.spreadsheet.error', 'sheet_id',
         string='List of errors', readonly=True)
+    profile_next_run = fields.Boolean(
+        copy=False,
+        help='Code imports only. Profile the code and the SQL queries of the '
+        'next import (or the next batch of a background import) and attach '
+        'the report to its log. It is unchecked after the import.')
+    compact_records = fields.Boolean(
+        help='Code imports only. Keep the rows in memory by column instead of '
+        'a dictionary per row, it uses much less memory on big sheets. The '
+        'rows of records can still be read like dictionaries, '
+        'e.g. row[\'column\'], row.get(\'column\'), dict(row).')
+    stream_records = fields.Boolean(
+        help='Code imports only. The rows of records are read while the code '
+        'iterates them instead of loading the whole sheet in memory, so '
+        'records can be iterated only once and len(records) can not be used. '
+        'Call commit() in the code to save the rows imported so far and free '
+        'the memory used by the ORM.')
+    prevalidate_rows = fields.Boolean(
+        string='Pre-validate rows', default=True,
+        help='Native imports only. Check the dates, numbers and selection '
+        'values of each batch before importing it. The rows with invalid '
+        'values are saved as errors and the rest of the batch is imported, '
+        'instead of failing the whole batch.')
+    error_limit = fields.Integer(
+        default=1000,
+        help='Maximum number of errors saved per import, the rest are only '
+        'counted in a summary error. Use 0 to save all the errors.')
     log_ids = fields.One2many(
         'google.spreadsheet.log', 'sheet_id',
         string='List of logs', readonly=True)
@@ -73,6 +168,24 @@ class GoogleDriveSheet(models.Model):
         help='Used to define the size of the batch of records that will be '
         'imported at the same time, this helps to prevent CPU timeouts.',
         default=50, required=True)
+    adaptive_batch = fields.Boolean(
+        string='Adaptive batch size',
+        help='Change the size of the batches after each batch, so each batch '
+        'takes about the target time. The batch size is used as the first '
+        'size.')
+    batch_target_time = fields.Float(
+        string='Target time per batch', default=5.0,
+        help='Seconds that each batch should take when the adaptive batch '
+        'size is used.')
+    batch_size_min = fields.Integer(
+        string='Minimum batch size', default=10,
+        help='Smallest batch used with the adaptive batch size, the batches '
+        'of the background import are saved with this size.')
+    batch_size_max = fields.Integer(
+        string='Maximum batch size', default=5000)
+    adaptive_batch_size = fields.Integer(
+        readonly=True, copy=False,
+        help='Last batch size calculated by the adaptive batch size.')
     date_format = fields.Char(default='%d-%m-%Y')
     datetime_format = fields.Char(default='%d-%m-%Y %H:%M:%S')
     separator = fields.Char(default=',')
@@ -112,10 +225,85 @@ class GoogleDriveSheet(models.Model):
     data = fields.Text(readonly=True)
     store_data = fields.Text(readonly=True)
     background_import = fields.Boolean(readonly=True)
+    chunk_ids = fields.One2many(
+        'google.spreadsheet.chunk', 'sheet_id',
+        string='Background batches', readonly=True)
+    chunk_count = fields.Integer(
+        compute='_compute_chunk_progress', string='Batches')
+    chunk_done_count = fields.Integer(
+        compute='_compute_chunk_progress', string='Batches imported')
+    chunk_row_count = fields.Integer(
+        compute='_compute_chunk_progress', string='Rows')
+    chunk_row_done_count = fields.Integer(
+        compute='_compute_chunk_progress', string='Rows imported')
+    background_progress = fields.Float(
+        compute='_compute_chunk_progress', string='Progress')
+    checkpoint_row = fields.Integer(
+        compute='_compute_chunk_progress', string='Rows committed',
+        help='Rows of the background import already committed: the rows of '
+        'the batches imported and the ones saved by commit() in streamed '
+        'code imports, so a worker that fails resumes each batch after its '
+        'rows committed.')
+    key_column = fields.Char(
+        help='Column of the spreadsheet that identifies each row. If it is '
+        'defined only the rows that are new or changed since the last import '
+        'are imported. The row numbers of the errors refer to the rows sent '
+        'to the import.')
+    skip_unchanged = fields.Boolean(
+        help='If the spreadsheet and the import options did not change since '
+        'the last import without errors the upload is skipped.')
+    content_hash = fields.Char(
+        readonly=True, copy=False,
+        help='Technical field used to save the hash of the import options '
+        'and the content of the last import without errors.')
+    source_revision = fields.Char(
+        readonly=True, copy=False,
+        help='Technical field used to save the version of the file in Google '
+        'Drive of the last import without errors.')
+    source_modified_time = fields.Datetime(
+        readonly=True, copy=False,
+        help='Last modification of the file in Google Drive at the moment of '
+        'the last import.')
 
-    def _get_content(self, id_file=""):
+    def _compute_chunk_progress(self):
+        groups = self.env['google.spreadsheet.chunk'].read_group(
+            [('sheet_id', 'in', self.ids)],
+            ['sheet_id', 'state', 'row_count', 'committed_row_count'],
+            ['sheet_id', 'state'], lazy=False)
+        progress = {}
+        for group in groups:
+            values = progress.setdefault(group['sheet_id'][0], {
+                'chunk_count': 0,
+                'chunk_done_count': 0,
+                'chunk_row_count': 0,
+                'chunk_row_done_count': 0,
+                'checkpoint_row': 0,
+            })
+            values['chunk_count'] += group['__count']
+            values['chunk_row_count'] += group['row_count']
+            if group['state'] == 'done':
+                values['chunk_done_count'] += group['__count']
+                values['chunk_row_done_count'] += group['row_count']
+                values['checkpoint_row'] += group['row_count']
+            else:
+                values['checkpoint_row'] += group['committed_row_count']
+        for rec in self:
+            values = progress.get(rec.id, {
+                'chunk_count': 0,
+                'chunk_done_count': 0,
+                'chunk_row_count': 0,
+                'chunk_row_done_count': 0,
+                'checkpoint_row': 0,
+            })
+            values['background_progress'] = (
+                values['chunk_count'] and
+                100.0 * values['chunk_done_count'] / values['chunk_count'])
+            rec.update(values)
+
+    def _get_content_request(self, id_file=""):
+        """ Returns the URL and the parameters to download the sheet. """
         self.ensure_one()
-        access_token = self.env['google.drive.config'].get_access_token()
+        access_token = self.env['google.spreadsheet.file']._get_access_token()
         params = {
             'access_token': access_token,
             'tqx': 'out:csv',
@@ -128,8 +316,258 @@ class GoogleDriveSheet(models.Model):
             params['range'] = self.sheet_range
         if self.query:
             params['tq'] = self.query
-        url = 'https://docs.google.com/spreadsheets/d/%s/gviz/tq' % id_file
-        return requests.get(url, params=params)
+        url = google_client.GVIZ_URL % id_file
+        return url, params
+
+    def _get_content(self, id_file=""):
+        url, params = self._get_content_request(id_file)
+        return google_client.call(
+            lambda: google_client.get_http_session().get(
+                url, params=params, stream=True, timeout=DOWNLOAD_TIMEOUT),
+            id_file=id_file)
+
+    def _check_content_status(self, status_code):
+        if status_code != 200:
+            if status_code in (401, 403):
+                self.env['google.spreadsheet.file']._clear_access_token()
+            raise ValidationError(_(
+                'There was an error, please contact the Administrator'))
+
+    @api.model
+    def _iter_response_lines(
+            self, response, encoding, digest=None, stats=None):
+        """ Decodes the streamed response and yields it line by line (line
+        breaks included), only one piece of the response is kept in memory at
+        the same time.
+
+        :param digest: hashlib object updated with the raw content
+        :param stats: dictionary updated with the bytes downloaded
+        """
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        pending = ''
+        with response:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                if digest is not None:
+                    digest.update(chunk)
+                if stats is not None:
+                    stats['bytes'] = stats.get('bytes', 0) + len(chunk)
+                lines = (pending + decoder.decode(chunk)).split('\n')
+                pending = lines.pop()
+                for line in lines:
+                    yield line + '\n'
+        pending += decoder.decode(b'', final=True)
+        if pending:
+            yield pending
+
+    @api.model
+    def _spool_lines(self, lines):
+        """ Writes the lines into a temporary file, kept in memory while it is
+        small, and returns it ready to be read. """
+        content = tempfile.SpooledTemporaryFile(
+            max_size=SPOOL_MAX_SIZE, mode='w+', encoding='utf-8',
+            newline='')
+        content.writelines(lines)
+        content.seek(0)
+        return content
+
+    @api.model
+    def _fetch_content(
+            self, id_file, url, params, encoding, digest=None, stats=None):
+        """ Downloads and spools the content of a sheet. It does not use the
+        ORM, so it can run in another thread.
+
+        :param stats: dictionary updated with the retries and waits, the
+            bytes downloaded and the seconds spent downloading
+        :returns: tuple with the HTTP status and the spooled content
+        """
+        if stats is None:
+            stats = {}
+        time_start = time.monotonic()
+        response = google_client.call(
+            lambda: google_client.get_http_session().get(
+                url, params=params, stream=True, timeout=DOWNLOAD_TIMEOUT),
+            id_file=id_file, stats=stats)
+        if response.status_code != 200:
+            response.close()
+            return response.status_code, False
+        content = self._spool_lines(self._iter_response_lines(
+            response, encoding, digest=digest, stats=stats))
+        stats['fetch_time'] = time.monotonic() - time_start
+        return 200, content
+
+    def _use_batch_get(self):
+        self.ensure_one()
+        return self.fetch_mode == 'batch' and not self.query
+
+    def _get_batch_range(self):
+        """ Returns the range in A1 notation used to get the sheet from the
+        Sheets API. """
+        self.ensure_one()
+        sheet_name = self.sheet_id.name or self.file_id.sheet_ids[:1].name
+        if not sheet_name:
+            raise ValidationError(_(
+                'Get the information of the file %s to use the Sheets '
+                'API.') % self.file_id.display_name)
+        sheet_name = "'%s'" % sheet_name.replace("'", "''")
+        if self.sheet_range:
+            return '%s!%s' % (sheet_name, self.sheet_range)
+        return sheet_name
+
+    @api.model
+    def _fetch_batch(self, access_token, id_file, batch, stats=None):
+        """ Gets several ranges of a file with a single values.batchGet
+        request of the Sheets API and sets the result of each range in its
+        future as the HTTP status and the content spooled as CSV. It does not
+        use the ORM, so it can run in another thread.
+
+        :param batch: list of tuples with the range, the csv options, the
+            digest and the future of each sheet
+        :param stats: dictionary updated with the retries and waits, the
+            size of the CSV of all the ranges and the seconds spent
+            downloading
+        """
+        if stats is None:
+            stats = {}
+        time_start = time.monotonic()
+        try:
+            service = google_client.get_sheets_service(access_token)
+            response = google_client.call(
+                service.spreadsheets().values().batchGet(
+                    spreadsheetId=id_file,
+                    ranges=[sheet_range for sheet_range, dummy, dummy, dummy
+                            in batch]).execute,
+                id_file=id_file, stats=stats)
+            value_ranges = response.get('valueRanges', [])
+            contents = []
+            for index, (dummy, csv_options, digest, future) in enumerate(
+                    batch):
+                rows = (
+                    value_ranges[index].get('values', [])
+                    if index < len(value_ranges) else [])
+                width = max((len(row) for row in rows), default=0)
+                content = tempfile.SpooledTemporaryFile(
+                    max_size=SPOOL_MAX_SIZE, mode='w+', encoding='utf-8',
+                    newline='')
+                writer = csv.writer(
+                    content, lineterminator='\n', **csv_options)
+                # The Sheets API omits the empty cells at the end of each row.
+                writer.writerows(
+                    row + [''] * (width - len(row)) for row in rows)
+                stats['bytes'] = stats.get('bytes', 0) + content.tell()
+                content.seek(0)
+                if digest is not None:
+                    for line in content:
+                        digest.update(line.encode('utf-8'))
+                    content.seek(0)
+                contents.append((future, content))
+            stats['fetch_time'] = time.monotonic() - time_start
+            for future, content in contents:
+                if future.cancelled():
+                    # The import failed before using it.
+                    content.close()
+                else:
+                    future.set_result((200, content))
+        except HttpError as error:
+            for dummy, dummy, dummy, future in batch:
+                if not future.done():
+                    future.set_result((error.resp.status, False))
+        except Exception as error:
+            for dummy, dummy, dummy, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+
+    def _download_content(self, id_file, spool=False, digest=None):
+        """ Downloads the sheet and returns an iterable of text lines.
+
+        :param spool: if True the whole content is downloaded first into a
+            temporary file (in memory while it is small), so the connection
+            is not kept open while the rows are imported.
+        :param digest: hashlib object updated with the raw content, when the
+            content is not spooled it is updated while the lines are read.
+        """
+        self.ensure_one()
+        if self._use_batch_get():
+            future = Future()
+            self._fetch_batch(
+                self.env['google.spreadsheet.file']._get_access_token(),
+                id_file, [(self._get_batch_range(), self._get_csv_options(),
+                           digest, future)])
+            status_code, content = future.result()
+            self._check_content_status(status_code)
+            return content
+        response = self._get_content(id_file)
+        if response.status_code != 200:
+            response.close()
+        self._check_content_status(response.status_code)
+        lines = self._iter_response_lines(
+            response, self.encoding or 'utf-8', digest=digest)
+        if not spool:
+            return lines
+        return self._spool_lines(lines)
+
+    @api.model
+    def _get_download_workers(self):
+        """ Returns the number of sheets downloaded at the same time. """
+        workers = self.env['ir.config_parameter'].sudo().get_param(
+            'google_spreadsheet_import.download_workers', '4')
+        try:
+            return max(int(workers), 1)
+        except ValueError:
+            _logger.warning(
+                'Invalid number of download workers %r, using 4.', workers)
+            return 4
+
+    def _start_downloads(self):
+        """ Starts the download of the sheets that are not imported in the
+        background in a pool of threads, so they are downloaded at the same
+        time while the sheets are imported one by one in the main thread.
+        The sheets without changes are logged and skipped.
+
+        :returns: dictionary with the sheet id as key and a tuple with the
+            revision, modification date, digest, future and retry stats of
+            the download
+        """
+        downloads = {}
+        sheets = self.filtered(lambda s: not s.background_import)
+        if not sheets:
+            return downloads
+        executor = ThreadPoolExecutor(
+            max_workers=min(len(sheets), self._get_download_workers()))
+        batches = {}
+        batch_stats = {}
+        for rec in sheets:
+            revision = modified_time = False
+            if rec.skip_unchanged:
+                revision, modified_time = rec._get_source_revision()
+                if revision and revision == rec.source_revision:
+                    rec._log_unchanged()
+                    continue
+            digest = rec._get_content_digest()
+            id_file = rec.file_id.id_file
+            if rec._use_batch_get():
+                future = Future()
+                batches.setdefault(id_file, []).append((
+                    rec._get_batch_range(), rec._get_csv_options(), digest,
+                    future))
+                # The sheets of the same file share the request.
+                stats = batch_stats.setdefault(id_file, {})
+            else:
+                stats = {}
+                url, params = rec._get_content_request(id_file)
+                future = executor.submit(
+                    self._fetch_content, id_file, url, params,
+                    rec.encoding or 'utf-8', digest, stats)
+            downloads[rec.id] = (
+                revision, modified_time, digest, future, stats)
+        if batches:
+            access_token = self.env[
+                'google.spreadsheet.file']._get_access_token()
+            for id_file, batch in batches.items():
+                executor.submit(
+                    self._fetch_batch, access_token, id_file, batch,
+                    batch_stats[id_file])
+        executor.shutdown(wait=False)
+        return downloads
 
     @api.model
     def _split_list(self, records, number):
@@ -139,10 +577,167 @@ class GoogleDriveSheet(models.Model):
         number = 5
         returns [[1, 2, 3, 4, 5], [6, 7, 8, 9, 10]]
         """
-        def chunks(records, number):
-            for index in range(0, len(records), number):
-                yield records[index:index+number]
-        return list(chunks(records, number))
+        return list(self._iter_batches(records, number))
+
+    @api.model
+    def _iter_batches(self, records, number):
+        """ Yields the batches of _split_list, it consumes any iterable
+        lazily so only one batch is kept in memory at the same time.
+        """
+        records = iter(records)
+        batch = list(islice(records, number))
+        while batch:
+            yield batch
+            batch = list(islice(records, number))
+
+    def _get_csv_options(self):
+        """ Returns the csv module format parameters defined in the sheet. """
+        self.ensure_one()
+        return {
+            'delimiter': self.separator or ',',
+            'quotechar': self.quoting or '"',
+        }
+
+    def _iter_csv_rows(self, data):
+        """ Parses the spreadsheet content following RFC 4180, so quoted
+        cells with commas or line breaks are kept in a single cell. The rows
+        are yielded lazily and empty lines are skipped.
+
+        :param data: iterable of text lines with the CSV content
+        """
+        self.ensure_one()
+        for row in csv.reader(data, **self._get_csv_options()):
+            if row:
+                yield row
+
+    @api.model
+    def _get_import_rows(self, rows, header):
+        """ Keeps only the cells of the columns mapped to a field and removes
+        the empty rows, the same way base_import does before calling load().
+        """
+        indices = [index for index, field in enumerate(header) if field]
+        import_rows = (
+            [row[index] if index < len(row) else '' for index in indices]
+            for row in rows)
+        return [row for row in import_rows if any(row)]
+
+    def _get_header_field(self, field_path):
+        """ Returns the field of a column of a native import, following the
+        relational fields of the path, or None for the External IDs and the
+        columns that are not fields. """
+        model = self.env[self.model]
+        names = (field_path or '').split('/')
+        if names[-1] in ('id', '.id'):
+            # External IDs and database IDs are resolved by load().
+            return None
+        for name in names[:-1]:
+            field = model._fields.get(name)
+            if not field or not field.relational:
+                return None
+            model = self.env[field.comodel_name]
+        return model._fields.get(names[-1])
+
+    def _get_column_coercers(self, header):
+        """ Returns the functions that check and convert the values of the
+        columns of a native import before calling load().
+
+        :returns: list of tuples with the index of the column, the field and
+            a function that returns the value converted as base_import does
+            or raises ValueError
+        """
+        self.ensure_one()
+        date_format = self.date_format or ''
+        datetime_format = self.datetime_format or ''
+        thousand = self.float_thousand_separator or ','
+        decimal = self.float_decimal_separator or '.'
+
+        def coerce_date(value):
+            return fields.Date.to_string(
+                datetime.datetime.strptime(value, date_format))
+
+        def coerce_datetime(value):
+            if datetime_format:
+                try:
+                    return fields.Datetime.to_string(
+                        datetime.datetime.strptime(value, datetime_format))
+                except ValueError:
+                    pass
+            return fields.Datetime.to_string(
+                datetime.datetime.strptime(value, date_format))
+
+        def check_float(value):
+            number = NUMBER_CLEAN_RE.sub('', value).strip('()')
+            float(number.replace(thousand, '').replace(decimal, '.'))
+            return value
+
+        def check_integer(value):
+            int(value)
+            return value
+
+        def get_selection_check(field):
+            allowed = set()
+            for env in (self.with_context(lang=None).env, self.env):
+                for key, label in field.get_description(env)['selection']:
+                    allowed.update((str(key).lower(), str(label).lower()))
+
+            def check_selection(value):
+                if value.lower() not in allowed:
+                    raise ValueError(_('%s is not a valid option') % value)
+                return value
+            return check_selection
+
+        coercers = []
+        for index, field_path in enumerate(header):
+            field = field_path and self._get_header_field(field_path)
+            if not field:
+                continue
+            if field.type == 'date':
+                coercer = coerce_date
+            elif field.type == 'datetime':
+                coercer = coerce_datetime
+            elif field.type in ('float', 'monetary'):
+                coercer = check_float
+            elif field.type == 'integer':
+                coercer = check_integer
+            elif field.type == 'selection':
+                coercer = get_selection_check(field)
+            else:
+                continue
+            coercers.append((index, field, coercer))
+        return coercers
+
+    @api.model
+    def _prevalidate_rows(self, rows, header, coercers):
+        """ Checks and converts the rows of a batch column by column and
+        removes the empty rows and the rows with invalid values.
+
+        :returns: tuple with the valid rows converted, the positions of the
+            valid rows in rows and a list of tuples with the position, the
+            field, the value and the message of each rejected row
+        """
+        indices = [index for index, field in enumerate(header) if field]
+        positions = [
+            position for position, row in enumerate(rows)
+            if any(row[index] for index in indices if index < len(row))]
+        converted = [list(rows[position]) for position in positions]
+        rejected = {}
+        for index, field, coercer in coercers:
+            for position, row in enumerate(converted):
+                value = row[index].strip() if index < len(row) else ''
+                if not value or position in rejected:
+                    continue
+                try:
+                    row[index] = coercer(value)
+                except ValueError as error:
+                    rejected[position] = (
+                        positions[position], field, value, str(error))
+        valid = [
+            position for position in range(len(converted))
+            if position not in rejected]
+        return (
+            [converted[position] for position in valid],
+            [positions[position] for position in valid],
+            list(rejected.values()))
 
     def action_open_native_import(self):
         self.ensure_one()
@@ -162,6 +757,164 @@ class GoogleDriveSheet(models.Model):
             }
         }
 
+    def _get_content_digest(self):
+        """ Returns a sha256 object initialized with the options that change
+        the result of the import, so the hash of the content changes when
+        the content or the way to import it changes. """
+        self.ensure_one()
+        options = [
+            self.file_id.id_file, self.sheet_id.name, self.sheet_range,
+            self.query, self.fix_header, self.header_value, self.fetch_mode,
+            self.model,
+            self.import_type, self.code, self.context, self.separator,
+            self.quoting, self.encoding, self.date_format,
+            self.datetime_format, self.float_decimal_separator,
+            self.float_thousand_separator,
+        ]
+        return hashlib.sha256(repr(options).encode('utf-8'))
+
+    def _get_source_revision(self):
+        """ Returns the revision of the file in Google Drive combined with
+        the import options and the last modification date of the file, or
+        (False, False) if Google Drive does not provide them. """
+        self.ensure_one()
+        metadata = self.file_id._get_drive_metadata()
+        if not metadata.get('version'):
+            return False, False
+        modified_time = metadata.get('modifiedTime')
+        if modified_time:
+            modified_time = datetime.datetime.strptime(
+                modified_time[:19], '%Y-%m-%dT%H:%M:%S')
+        revision = '%s:%s' % (
+            metadata['version'], self._get_content_digest().hexdigest())
+        return revision, modified_time
+
+    def _get_row_key_getter(self, data):
+        """ Returns a function that extracts the value of the key column of
+        a row, or None if the sheet does not use a key column. """
+        self.ensure_one()
+        if not self.key_column:
+            return None
+        if self.import_type == 'native':
+            index = data['key_index']
+            return lambda row: row[index] if index < len(row) else ''
+        key_column = self.key_column
+        return lambda row: row.get(key_column) or ''
+
+    @api.model
+    def _get_row_fingerprint(self, row, seed):
+        digest = seed.copy()
+        if not isinstance(row, (list, dict)):
+            row = dict(row)
+        digest.update(json.dumps(row, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _iter_changed_rows(self, records, key_getter, stats, new_fingerprints):
+        """ Yields only the rows that are new or changed compared with the
+        fingerprints saved in the last imports. The fingerprints of the rows
+        that are not in the spreadsheet anymore are removed.
+
+        :param stats: dictionary updated with the number of new, changed,
+            unchanged and deleted rows
+        :param new_fingerprints: dictionary where the fingerprint of each
+            row is added by key before yielding it, so the code can not
+            change the value saved with _save_row_fingerprints
+        """
+        self.ensure_one()
+        stats.update(new=0, changed=0, unchanged=0, deleted=0)
+        self._cr.execute("""
+            SELECT key, fingerprint FROM google_spreadsheet_row
+            WHERE sheet_id = %s
+        """, (self.id,))
+        fingerprints = dict(self._cr.fetchall())
+        seed = self._get_content_digest()
+        seen = set()
+        for row in records:
+            key = key_getter(row)
+            if not key:
+                stats['new'] += 1
+                yield row
+                continue
+            seen.add(key)
+            fingerprint = self._get_row_fingerprint(row, seed)
+            if key not in fingerprints:
+                stats['new'] += 1
+            elif fingerprints[key] != fingerprint:
+                stats['changed'] += 1
+            else:
+                stats['unchanged'] += 1
+                continue
+            new_fingerprints[key] = fingerprint
+            yield row
+        deleted = [key for key in fingerprints if key not in seen]
+        stats['deleted'] = len(deleted)
+        if deleted:
+            self._cr.execute("""
+                DELETE FROM google_spreadsheet_row
+                WHERE sheet_id = %s AND key = ANY(%s)
+            """, (self.id, deleted))
+
+    def _get_row_fingerprints(self, rows, key_getter):
+        """ Returns a dictionary with the fingerprint of each row by key, the
+        rows without key are not included. """
+        self.ensure_one()
+        seed = self._get_content_digest()
+        values = {}
+        for row in rows:
+            key = key_getter(row)
+            if key:
+                values[key] = self._get_row_fingerprint(row, seed)
+        return values
+
+    def _save_row_fingerprints(self, values):
+        """ Saves the fingerprints of rows already imported, so they are
+        skipped in the next imports while they do not change.
+
+        :param values: dictionary with the fingerprints by key, calculated
+            before importing the rows
+        """
+        self.ensure_one()
+        if not values:
+            return
+        execute_values(self._cr._obj, """
+            INSERT INTO google_spreadsheet_row (sheet_id, key, fingerprint)
+            VALUES %s
+            ON CONFLICT (sheet_id, key)
+            DO UPDATE SET fingerprint = EXCLUDED.fingerprint
+        """, [(self.id, key, fingerprint)
+              for key, fingerprint in values.items()])
+
+    def action_reset_row_fingerprints(self):
+        self.check_access_rights('write')
+        self.check_access_rule('write')
+        # Without them the next import could be skipped as unchanged.
+        self.write({
+            'content_hash': False,
+            'source_revision': False,
+        })
+        self._cr.execute("""
+            DELETE FROM google_spreadsheet_row WHERE sheet_id = ANY(%s)
+        """, (self.ids,))
+
+    @api.model
+    def _get_row_stats_message(self, stats):
+        return 'New: %s, Changed: %s, Unchanged: %s, Deleted: %s' % (
+            stats['new'], stats['changed'], stats['unchanged'],
+            stats['deleted'])
+
+    def _log_unchanged(self):
+        for rec in self:
+            _logger.info(
+                'Sheet %s (%s) skipped, no changes since the last import.',
+                rec.name, rec.id)
+            rec.write({
+                'log_ids': [(0, 0, {
+                    'name': 'No changes since the last import',
+                    'duration': str(datetime.timedelta()),
+                    'ids_related': '',
+                })]
+            })
+
     def clean_log(self):
         for rec in self:
             rec.error_ids.unlink()
@@ -169,70 +922,311 @@ class GoogleDriveSheet(models.Model):
     @api.constrains('code')
     def _check_python_code(self):
         for rec in self.filtered('code'):
-            msg = test_python_expr(expr=rec.code.strip(), mode="exec")
-            if msg:
-                raise ValidationError(msg)
+            try:
+                rec._get_compiled_code()
+            except (SyntaxError, TypeError, ValueError):
+                raise ValidationError(
+                    test_python_expr(expr=rec.code.strip(), mode="exec"))
 
-    def upload(self):
+    def write(self, vals):
+        if 'code' in vals:
+            self._clear_compiled_code()
+        return super().write(vals)
+
+    def unlink(self):
+        self._clear_compiled_code()
+        return super().unlink()
+
+    def _clear_compiled_code(self):
         for rec in self:
-            if rec.background_import:
-                data = rec.data
-            else:
-                response = self._get_content(rec.file_id.id_file)
-                if response.status_code != 200:
-                    raise ValidationError(_(
-                        'There was an error, please contact the Administrator')
-                    )
-                data = response.text
-            data = rec._process_data(data)
-            time_start = datetime.datetime.now()
-            res = getattr(self, '_process_%s' % rec.import_type)(data)
-            name = 'Records created: %s' % len(res.get('ids'))
-            if res.get('errors'):
-                name += '\nErrors: %s' % len(res.get('errors'))
-            time_end = datetime.datetime.now()
-            rec.write({
-                'store_data': res.get('store_data'),
-                'log_ids': [(0, 0, {
-                    'name': name,
-                    'duration': str(time_end - time_start),
-                    'ids_related': (
-                        ','.join(str(id) for id in res.get('ids')) or ''),
-                })]
-            })
-            return res.get('action')
+            _compiled_codes.pop((self._cr.dbname, rec.id), None)
+
+    def _get_compiled_code(self):
+        """ Returns the code compiled and checked like safe_eval does. It is
+        compiled once per version of the code in each process, so the batches
+        of the same import do not compile it again. """
+        self.ensure_one()
+        code = self.code.strip()
+        digest = hashlib.sha256(code.encode('utf-8')).hexdigest()
+        key = (self._cr.dbname, self.id)
+        cached = _compiled_codes.get(key)
+        if cached and cached[0] == digest:
+            return cached[1]
+        compiled = test_expr(code, _SAFE_OPCODES, mode='exec')
+        if isinstance(self.id, int):
+            _compiled_codes[key] = (digest, compiled)
+        return compiled
+
+    def _eval_code(self, eval_context):
+        """ Executes the code of the sheet like safe_eval with nocopy, but
+        using the compiled code of _get_compiled_code. It is a copy of the
+        last part of safe_eval of Odoo 15.0 (builtins, check_values and the
+        handling of the exceptions), review it when upgrading. """
+        self.ensure_one()
+        compiled = self._get_compiled_code()
+        eval_context['__builtins__'] = _BUILTINS
+        check_values(eval_context)
+        try:
+            # pylint: disable=eval-used
+            eval(compiled, eval_context)
+        except SAFE_EVAL_RERAISE:
+            raise
+        except Exception as error:
+            raise ValueError('%s: "%s" while evaluating\n%r' % (
+                type(error), error, self.code.strip()))
+
+    def upload(self):
+        downloads = self._start_downloads()
+        action = False
+        content = False
+        try:
+            for rec in self:
+                chunk = self.env['google.spreadsheet.chunk']
+                content = False
+                vals = {}
+                stats = {}
+                query_start = getattr(self._cr, 'sql_log_count', 0)
+                memory_start = rec._get_peak_memory()
+                parse_start = time.monotonic()
+                if rec.background_import:
+                    chunk = rec._get_next_chunk(rec._get_batch_size())
+                    if not chunk:
+                        if not rec._has_pending_chunks():
+                            rec.deactivate_background_import()
+                        continue
+                    data = chunk._get_data()
+                elif rec.id not in downloads:
+                    # Skipped because it did not change.
+                    continue
+                else:
+                    revision, modified_time, digest, future, stats = (
+                        downloads.pop(rec.id))
+                    status_code, content = future.result()
+                    rec._check_content_status(status_code)
+                    content_hash = digest.hexdigest()
+                    vals.update({
+                        'content_hash': content_hash,
+                        'source_revision': revision,
+                        'source_modified_time': modified_time,
+                    })
+                    if rec.skip_unchanged and content_hash == rec.content_hash:
+                        content.close()
+                        rec.write(vals)
+                        rec._log_unchanged()
+                        continue
+                    parse_start = time.monotonic()
+                    data = rec._process_data(content)
+                parse_time = time.monotonic() - parse_start
+                time_start = datetime.datetime.now()
+                res = getattr(rec, '_process_%s' % rec.import_type)(data)
+                # The rows are not needed anymore, they are not kept twice
+                # in the database until the end of the import.
+                chunk.write({'state': 'done', 'data': False})
+                if content:
+                    content.close()
+                name = 'Records created: %s' % len(res.get('ids'))
+                if res.get('errors'):
+                    name += '\nErrors: %s' % len(res.get('errors'))
+                if data.get('row_stats'):
+                    name += '\n%s' % rec._get_row_stats_message(
+                        data['row_stats'])
+                time_end = datetime.datetime.now()
+                batch_sizes = res.get('batch_sizes')
+                if batch_sizes is None:
+                    # The code is executed once with all the records.
+                    batch_sizes = [res['row_count']]
+                    if rec.adaptive_batch:
+                        vals['adaptive_batch_size'] = (
+                            rec._get_adaptive_batch_size(
+                                rec._get_batch_size(), res['row_count'],
+                                (time_end - time_start).total_seconds()))
+                elif rec.adaptive_batch:
+                    vals['adaptive_batch_size'] = res['next_batch_size']
+                if res.get('profile_report'):
+                    # Only the next run is profiled.
+                    vals['profile_next_run'] = False
+                if res.get('errors'):
+                    # Keep the next upload from being skipped, so the rows with
+                    # errors can be imported again.
+                    vals.update({
+                        'content_hash': False,
+                        'source_revision': False,
+                    })
+                duration = (time_end - time_start).total_seconds()
+                rows = sum(batch_sizes)
+                batch_times = res.get('batch_times', [])
+                rec.write(dict(vals, **{
+                    'store_data': res.get('store_data'),
+                    'log_ids': [(0, 0, {
+                        'name': name,
+                        'duration': str(time_end - time_start),
+                        'fetch_time': stats.get('fetch_time', 0.0),
+                        'fetch_bytes': stats.get('bytes', 0),
+                        'parse_time': parse_time + res.get('parse_time', 0.0),
+                        'process_time': duration,
+                        'row_count': rows,
+                        'rows_per_second': (
+                            rows / duration if duration else 0.0),
+                        'orm_time_p50': rec._get_percentile(batch_times, 50),
+                        'orm_time_p95': rec._get_percentile(batch_times, 95),
+                        'orm_time_max': max(batch_times, default=0.0),
+                        'query_count': (
+                            getattr(self._cr, 'sql_log_count', 0) -
+                            query_start),
+                        'memory_peak_delta': (
+                            rec._get_peak_memory() - memory_start),
+                        'batch_sizes': rec._format_batch_sizes(batch_sizes),
+                        'lookup_hits': res.get(
+                            'lookup_stats', {}).get('hits', 0),
+                        'lookup_misses': res.get(
+                            'lookup_stats', {}).get('misses', 0),
+                        'retry_count': stats.get('retries', 0),
+                        'retry_wait': stats.get('wait', 0.0),
+                        'profile_report': res.get('profile_report') and (
+                            base64.b64encode(
+                                res['profile_report'].encode('utf-8'))),
+                        'profile_report_name': res.get('profile_report') and (
+                            'profile_%s_%s.txt' % (
+                                rec.id, fields.Datetime.now().strftime(
+                                    '%Y%m%d_%H%M%S'))),
+                        'ids_related': (
+                            ','.join(str(id) for id in res.get('ids')) or ''),
+                    })]
+                }))
+                action = res.get('action')
+        finally:
+            if content:
+                content.close()
+            # The downloads not imported when the import fails.
+            self._discard_downloads(downloads)
+        return action
+
+    @api.model
+    def _discard_downloads(self, downloads):
+        """ Cancels the downloads that did not start and closes the content
+        of the rest when they finish. """
+        for dummy, dummy, dummy, future, dummy in downloads.values():
+            if not future.cancel():
+                future.add_done_callback(self._close_download)
+
+    @api.model
+    def _close_download(self, future):
+        if future.cancelled() or future.exception():
+            return
+        dummy, content = future.result()
+        if content:
+            content.close()
+
+    @api.model
+    def _get_percentile(self, values, percent):
+        """ Returns the percentile of the values using the nearest rank. """
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[max(-(-len(values) * percent // 100), 1) - 1]
+
+    @api.model
+    def _get_peak_memory(self):
+        """ Returns the peak resident memory of the process in KB, or 0 if
+        it is not available in the platform. """
+        if resource is None:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def _save_errors(self, errors, row_offset=0):
+        """ Creates the errors of an import in a single batch. If there are
+        more errors than the limit of the sheet only the first ones are saved
+        followed by an error with the number of errors not saved.
+
+        :param errors: list of values of google.spreadsheet.error
+        :param row_offset: first row of the batch of a background import,
+            the errors saved by the previous batches count for the limit
+        """
+        self.ensure_one()
+        limit = self.error_limit
+        if limit and row_offset:
+            # The errors created since the background import was activated.
+            first_chunk = self.env['google.spreadsheet.chunk'].search(
+                [('sheet_id', '=', self.id)], limit=1)
+            saved = self.env['google.spreadsheet.error'].search_count([
+                ('sheet_id', '=', self.id),
+                ('create_date', '>=', first_chunk.create_date),
+            ])
+            limit = max(limit - saved, 0)
+        if self.error_limit and len(errors) > limit:
+            errors = errors[:limit] + [{
+                'type': 'error',
+                'message': _('%s more errors were not saved.') % (
+                    len(errors) - limit),
+            }]
+        for error in errors:
+            error['sheet_id'] = self.id
+        return self.env['google.spreadsheet.error'].create(errors)
+
+    def _flush_logs(self, logs):
+        """ Saves the messages buffered by log() in ir.logging with a single
+        insert. A new cursor is used so the messages are kept even if the
+        import is rolled back.
+
+        :param logs: list of ir_logging rows, it is emptied
+        """
+        if not logs:
+            return
+        with self.pool.cursor() as cr:
+            execute_values(cr._obj, """
+                INSERT INTO ir_logging(
+                create_date, create_uid, type, dbname, name, level,
+                message, path, line, func)
+                VALUES %s
+            """, logs)
+        del logs[:]
 
-    def _get_eval_context(self, records):
+    def _get_eval_context(
+            self, records, error_buffer=None, log_buffer=None,
+            lookup_stats=None, on_commit=None, after_commit=None):
         """ Prepare the context used when evaluating python code, like the
         python formulas or code server actions.
 
         :param records: dictionary with google spreadsheet data
         :type DictReader: records to be processed
+        :param error_buffer: list where log_error adds the errors, they must
+            be saved with _save_errors. If it is not provided the errors are
+            created immediately.
+        :param log_buffer: list where log adds the messages, they are saved
+            every LOG_BUFFER_SIZE messages and the rest must be saved with
+            _flush_logs. If it is not provided each message is saved
+            immediately.
+        :param lookup_stats: dictionary updated with the hits and misses of
+            the cache of lookup
+        :param on_commit: function called by commit before committing, it
+            saves the progress of the import. commit is only available when
+            it is provided, otherwise the rows committed would be imported
+            again by a background import that fails.
+        :param after_commit: function called by commit after committing
         :returns: dict -- evaluation context given to (safe_)safe_eval """
         self.ensure_one()
 
+        logs = log_buffer if log_buffer is not None else []
+
         def log(message, level="info"):
-            with self.pool.cursor() as cr:
-                cr.execute("""
-                    INSERT INTO ir_logging(
-                    create_date, create_uid, type, dbname, name, level,
-                    message, path, line, func)
-                    VALUES (
-                    NOW() at time zone 'UTC',
-                    %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    self.env.uid, 'server', self._cr.dbname, __name__, level,
-                    message, "google spreadsheet", self.id, self.name))
+            logs.append((
+                datetime.datetime.utcnow(), self.env.uid, 'server',
+                self._cr.dbname, __name__, level, message,
+                "google spreadsheet", self.id, self.name))
+            if log_buffer is None or len(logs) >= LOG_BUFFER_SIZE:
+                self._flush_logs(logs)
 
         def log_error(message, field=False, record=False, type='error'):
-            self.write({
-                'error_ids': [(0, 0, {
-                    'field': field,
-                    'message': message,
-                    'record': record,
-                    'type': type,
-                })],
-            })
+            error = {
+                'field': field,
+                'message': message,
+                'record': record,
+                'type': type,
+            }
+            if error_buffer is None:
+                self._save_errors([error])
+            else:
+                error_buffer.append(error)
 
         def create_external_id(record, xml_id):
             self.env['ir.model.data'].create({
@@ -241,7 +1235,108 @@ class GoogleDriveSheet(models.Model):
                 'name': xml_id,
                 'res_id': record.id,
             })
-        return {
+
+        def get_external_ids(xml_ids):
+            """ Returns a dictionary with the records of the External IDs
+            of the importation (__import__ module) found, with one query. The
+            keys are the External IDs as they were given, with or without
+            the __import__ prefix. """
+            names = {
+                xml_id: xml_id.split('__import__.', 1)[-1]
+                for xml_id in xml_ids}
+            self._cr.execute("""
+                SELECT name, model, res_id FROM ir_model_data
+                WHERE module = '__import__' AND name = ANY(%s)
+            """, (list(set(names.values())),))
+            rows = self._cr.fetchall()
+            prefetch_ids = {}
+            for dummy, model_name, res_id in rows:
+                prefetch_ids.setdefault(model_name, []).append(res_id)
+            records = {
+                name: self.env[model_name].browse(res_id).with_prefetch(
+                    prefetch_ids[model_name])
+                for name, model_name, res_id in rows
+            }
+            return {
+                xml_id: records[name] for xml_id, name in names.items()
+                if name in records
+            }
+
+        lookup_cache = OrderedDict()
+        if lookup_stats is None:
+            lookup_stats = {}
+        lookup_stats.update(hits=0, misses=0)
+
+        def _cache_lookup(key, record):
+            lookup_cache[key] = record
+            if len(lookup_cache) > LOOKUP_CACHE_SIZE:
+                lookup_cache.popitem(last=False)
+
+        def lookup(model_name, field_name, value):
+            """ Returns the first record of the model with the value in the
+            field, or an empty recordset. The records found are kept during
+            the whole import, the values not found are searched again so the
+            records created by the code after the lookup are found. """
+            key = (model_name, field_name, value)
+            if key in lookup_cache:
+                lookup_stats['hits'] += 1
+                lookup_cache.move_to_end(key)
+                return lookup_cache[key]
+            lookup_stats['misses'] += 1
+            record = self.env[model_name].search(
+                [(field_name, '=', value)], limit=1)
+            if record:
+                _cache_lookup(key, record)
+            return record
+
+        def prefetch_lookup(model_name, field_name, values):
+            """ Searches the records of all the values with a single query
+            and keeps them for lookup. The field can not be relational.
+            Only the values found are kept, the record value can differ from
+            the searched value (e.g. numbers or translated names), so the
+            values not matched are left for lookup to search them. """
+            values = {
+                value for value in values
+                if (model_name, field_name, value) not in lookup_cache}
+            if not values:
+                return
+            found = {}
+            for record in self.env[model_name].search(
+                    [(field_name, 'in', list(values))]):
+                found.setdefault(record[field_name], record)
+            for value in values:
+                if value in found:
+                    _cache_lookup(
+                        (model_name, field_name, value), found[value])
+
+        def create_external_ids(values):
+            """ Creates the External IDs of many records with multi-row
+            inserts, the existing ones are updated.
+
+            :param values: list of tuples (record, xml_id)
+            """
+            self.env['ir.model.data']._update_xmlids([{
+                'xml_id': '__import__.%s' % (
+                    xml_id.split('__import__.', 1)[-1]),
+                'record': record,
+            } for record, xml_id in values])
+
+        def commit():
+            """ Commits the rows imported so far and clears the cache of the
+            ORM, so the memory used does not grow with the rows imported. """
+            if on_commit:
+                on_commit()
+            self._flush_logs(logs)
+            self.env.cr.commit()  # pylint: disable=invalid-commit
+            self.env.cache.invalidate()
+            if after_commit:
+                after_commit()
+
+        def savepoint():
+            """ Returns a savepoint to use in a with statement, the changes
+            made inside it are rolled back if it raises an error. """
+            return self.env.cr.savepoint()
+        eval_context = {
             'records': records,
             'datetime': tools.safe_eval.datetime,
             'dateutil': tools.safe_eval.dateutil,
@@ -256,6 +1351,11 @@ class GoogleDriveSheet(models.Model):
             'ipdb': tools.safe_eval.ipdb,
             'math': math,
             'create_external_id': create_external_id,
+            'create_external_ids': create_external_ids,
+            'get_external_ids': get_external_ids,
+            'lookup': lookup,
+            'prefetch_lookup': prefetch_lookup,
+            'savepoint': savepoint,
             'log_error': log_error,
             'base64': base64,
             'json': json,
@@ -264,97 +1364,524 @@ class GoogleDriveSheet(models.Model):
             'store_data': (
                 self.store_data and json.loads(self.store_data) or {}),
         }
+        if on_commit:
+            eval_context['commit'] = commit
+        return eval_context
 
     def activate_background_import(self):
         for rec in self:
-            response = self._get_content(rec.file_id.id_file)
-            if response.status_code != 200:
-                raise ValidationError(_(
-                    'There was an error, please contact the Administrator')
-                )
-            data = rec._process_data(response.text)
-            data['records'] = self._split_list(
-                data['records'], self.batch_size)
-            rec.write({
-                'data': json.dumps(data, indent=2),
+            data = rec._process_data(
+                rec._download_content(rec.file_id.id_file))
+            records = data.pop('records')
+            row_stats = data.pop('row_stats', False)
+            # Calculated again with the rows of each batch, see _get_data.
+            data.pop('fingerprints', None)
+            rec.chunk_ids.unlink()
+            chunk_obj = self.env['google.spreadsheet.chunk']
+            vals_list = []
+            row_offset = 0
+            chunk_size = (
+                rec.batch_size_min if rec.adaptive_batch else rec.batch_size)
+            for sequence, batch in enumerate(
+                    self._iter_batches(records, chunk_size)):
+                vals_list.append({
+                    'sheet_id': rec.id,
+                    'sequence': sequence,
+                    'row_offset': row_offset,
+                    'row_count': len(batch),
+                    'data': json.dumps(
+                        [dict(row) for row in batch]
+                        if rec.import_type == 'code' else batch),
+                })
+                row_offset += len(batch)
+                if len(vals_list) >= 100:
+                    chunk_obj.create(vals_list)
+                    vals_list = []
+            chunk_obj.create(vals_list)
+            vals = {
+                'data': json.dumps(data),
                 'background_import': True,
-            })
+            }
+            if row_stats:
+                vals['log_ids'] = [(0, 0, {
+                    'name': 'Background import activated\n%s' % (
+                        rec._get_row_stats_message(row_stats)),
+                    'duration': str(datetime.timedelta()),
+                    'ids_related': '',
+                })]
+            rec.write(vals)
 
     def deactivate_background_import(self):
+        self.mapped('chunk_ids').unlink()
         self.write({
             'data': False,
-            'background_import': False
+            'background_import': False,
         })
 
+    def _get_next_chunk(self, rows=0):
+        """ Returns the first pending batch of the background import and locks
+        it. The lookup uses the (sheet_id, state, sequence) index so it does
+        not depend on the size of the spreadsheet, and batches locked by other
+        workers are skipped so they are never imported twice.
+
+        :param rows: if the first batch has less rows, the next pending
+            batches are also returned until this number of rows is reached.
+            Only the batches that follow the first one without a gap in the
+            sequence are returned, so the rows of the batch are consecutive.
+        """
+        self.ensure_one()
+        self._cr.execute("""
+            SELECT id, row_count, sequence FROM google_spreadsheet_chunk
+            WHERE sheet_id = %s AND state = 'pending'
+            ORDER BY sequence
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        """, (self.id,))
+        res = self._cr.fetchall()
+        if res and 0 < res[0][1] < rows:
+            sequence = res[0][2]
+            self._cr.execute("""
+                SELECT id, row_count, sequence FROM google_spreadsheet_chunk
+                WHERE sheet_id = %s AND state = 'pending'
+                    AND sequence > %s AND sequence < %s
+                ORDER BY sequence
+                FOR UPDATE SKIP LOCKED
+            """, (self.id, sequence, sequence + -(-rows // res[0][1])))
+            for row in self._cr.fetchall():
+                # A batch imported or locked by another worker in the middle.
+                if row[2] != res[-1][2] + 1:
+                    break
+                res.append(row)
+        return self.env['google.spreadsheet.chunk'].browse(
+            [chunk_id for chunk_id, dummy, dummy in res])
+
+    def _has_pending_chunks(self):
+        """ Returns True if the background import has batches not imported,
+        including the ones locked by other workers that _get_next_chunk
+        skips, so the import is not deactivated while they are imported. """
+        self.ensure_one()
+        self._cr.execute("""
+            SELECT 1 FROM google_spreadsheet_chunk
+            WHERE sheet_id = %s AND state = 'pending'
+            LIMIT 1
+        """, (self.id,))
+        return bool(self._cr.fetchone())
+
+    @api.constrains('batch_size', 'batch_size_min', 'batch_size_max')
+    def _check_batch_size(self):
+        for rec in self:
+            if rec.batch_size < 1 or rec.batch_size_min < 1:
+                raise ValidationError(_(
+                    'The batch sizes must be greater than zero.'))
+            if rec.batch_size_max < rec.batch_size_min:
+                raise ValidationError(_(
+                    'The maximum batch size must be greater than the minimum '
+                    'batch size.'))
+
+    def _get_batch_size(self):
+        """ Returns the size of the next batch, with the adaptive batch size
+        it starts with the batch size and continues with the last size
+        calculated. """
+        self.ensure_one()
+        if not self.adaptive_batch:
+            return self.batch_size
+        size = self.adaptive_batch_size or self.batch_size
+        return min(max(size, self.batch_size_min), self.batch_size_max)
+
+    def _get_adaptive_batch_size(self, size, rows, duration):
+        """ Returns the size of the next batch so it takes about the target
+        time, using the time per row of the last batch. The size can be at
+        most doubled or halved each time to avoid big jumps caused by a
+        single slow or fast batch.
+
+        :param size: size of the last batch
+        :param rows: number of rows imported in the last batch
+        :param duration: seconds that the last batch took
+        """
+        self.ensure_one()
+        if not rows or duration <= 0 or self.batch_target_time <= 0:
+            return size
+        target = rows * self.batch_target_time / duration
+        size = int(min(max(target, size / 2.0), size * 2.0))
+        return min(max(size, self.batch_size_min), self.batch_size_max)
+
+    @api.model
+    def _format_batch_sizes(self, sizes):
+        """ Returns the batch sizes in a short text, consecutive batches
+        with the same size are grouped. Example: [50, 50, 100] -> 50 x 2, 100
+        """
+        res = []
+        for size, group in groupby(sizes):
+            count = len(list(group))
+            res.append('%s x %s' % (size, count) if count > 1 else str(size))
+        return ', '.join(res)
+
+    @api.model
+    def _get_background_time_budget(self):
+        """ Returns the seconds that a cron execution can spend importing
+        batches, it must be lower than the interval of the cron and the
+        limit_time_real of the server. """
+        budget = self.env['ir.config_parameter'].sudo().get_param(
+            'google_spreadsheet_import.background_time_budget', '50')
+        try:
+            return float(budget)
+        except ValueError:
+            _logger.warning(
+                'Invalid background time budget %r, using 50 seconds.',
+                budget)
+            return 50.0
+
+    @api.model
+    def _get_background_workers(self):
+        """ Returns the number of threads used by the background import cron,
+        each thread uses its own database connection. """
+        workers = self.env['ir.config_parameter'].sudo().get_param(
+            'google_spreadsheet_import.background_workers', '1')
+        try:
+            return max(int(workers), 1)
+        except ValueError:
+            _logger.warning(
+                'Invalid number of background workers %r, using 1.', workers)
+            return 1
+
+    @api.model
+    def _claim_background_sheet(self, exclude_ids=None):
+        """ Returns a sheet with a background import in progress and locks it
+        until the end of the transaction. Sheets locked by other workers are
+        skipped, so several crons or threads can import different sheets at
+        the same time. """
+        self._cr.execute("""
+            SELECT id FROM google_spreadsheet
+            WHERE background_import AND active AND NOT id = ANY(%s)
+            ORDER BY sequence, id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        """, (list(exclude_ids or []),))
+        res = self._cr.fetchone()
+        return self.browse(res and res[0])
+
+    def _lock_background_sheet(self):
+        """ Locks the sheet again after a commit, returns False if another
+        worker took it in the meantime. """
+        self.ensure_one()
+        self._cr.execute("""
+            SELECT id FROM google_spreadsheet
+            WHERE id = %s AND background_import
+            FOR UPDATE SKIP LOCKED
+        """, (self.id,))
+        return bool(self._cr.fetchone())
+
+    def _lock_background_chunks(self, chunk_ids):
+        """ Locks again the batches being imported after a commit, returns
+        False if another worker took any of them in the meantime. """
+        self.ensure_one()
+        self._cr.execute("""
+            SELECT id FROM google_spreadsheet_chunk
+            WHERE id = ANY(%s) AND sheet_id = %s AND state = 'pending'
+            FOR UPDATE SKIP LOCKED
+        """, (list(chunk_ids), self.id))
+        return len(self._cr.fetchall()) == len(chunk_ids)
+
     def _process_background_import(self):
-        sheets = self.search([('background_import', '=', True)])
-        for sheet in sheets:
-            sheet.upload()
-            data = json.loads(sheet.data)
-            if not data['records']:
-                sheet.write({
-                    'data': False,
-                    'background_import': False,
-                })
+        deadline = time.monotonic() + self._get_background_time_budget()
+        workers = self._get_background_workers()
+        if workers == 1:
+            return self._run_background_import(deadline)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self._run_background_worker, deadline)
+                for dummy in range(workers)]
+            for future in futures:
+                future.result()
+
+    def _run_background_worker(self, deadline):
+        """ Entry point of the threads of the background import, each one
+        uses a new cursor because cursors can not be shared between
+        threads. """
+        threading.current_thread().dbname = self._cr.dbname
+        with self.pool.cursor() as cr:
+            env = api.Environment(cr, self.env.uid, self.env.context)
+            env[self._name]._run_background_import(deadline)
+
+    @api.model
+    def _run_background_import(self, deadline):
+        """ Imports the sheets with a background import in progress until the
+        deadline. Each pass claims one more sheet and imports one batch of
+        every sheet claimed, so a big sheet does not take the whole time
+        budget while the rest wait for the next execution of the cron. """
+        claimed_ids = []
+        sheets = []
+        stats = {}
+        while time.monotonic() < deadline:
+            sheet = self._claim_background_sheet(claimed_ids)
+            if sheet:
+                claimed_ids.append(sheet.id)
+                sheets.append(sheet)
+                stats[sheet.id] = [0, 0, 0.0]
+            if not sheets:
+                break
+            for sheet in list(sheets):
+                if time.monotonic() >= deadline:
+                    break
+                time_start = time.monotonic()
+                rows = None
+                try:
+                    # The lock of the claim is released by the commit of
+                    # each batch, the sheet is skipped from now on if
+                    # another worker took it in the meantime.
+                    if sheet._lock_background_sheet():
+                        rows = sheet._import_background_chunk()
+                except Exception:
+                    self._cr.rollback()
+                    _logger.exception(
+                        'Background import of sheet %s (%s) failed.',
+                        sheet.name, sheet.id)
+                if rows is None:
+                    sheets.remove(sheet)
+                    continue
+                sheet_stats = stats[sheet.id]
+                sheet_stats[0] += 1
+                sheet_stats[1] += rows
+                sheet_stats[2] += time.monotonic() - time_start
+        for sheet in self.browse(claimed_ids):
+            batches, rows, elapsed = stats[sheet.id]
+            if batches:
+                _logger.info(
+                    'Sheet %s (%s): %d batches, %d rows imported in %.2fs '
+                    '(%.2f rows/sec)', sheet.name, sheet.id, batches, rows,
+                    elapsed, rows / elapsed if elapsed else 0.0)
+
+    def _import_background_chunk(self):
+        """ Imports the next batch of the background import and commits it.
+        Returns the number of rows imported, or None if the sheet has no
+        batch left to import. """
+        self.ensure_one()
+        chunk = self._get_next_chunk(self._get_batch_size())
+        if not chunk:
+            if not self._has_pending_chunks():
+                self.deactivate_background_import()
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+            return None
+        rows = sum(chunk.mapped('row_count'))
+        self.upload()
+        # Commit after each batch so the progress is kept even if a later
+        # batch fails or the worker is killed.
+        self.env.cr.commit()  # pylint: disable=invalid-commit
+        return rows
 
     def _process_data(self, data):
         self.ensure_one()
-        if self.background_import:
-            data = json.loads(self.data)
-            if data['records']:
-                records = data['records'].pop(0)
-                self.data = json.dumps(data, indent=2)
-                data['records'] = records
-            else:
-                self.write({
-                    'data': False,
-                    'background_import': False,
-                })
-            return data
+        if isinstance(data, str):
+            data = StringIO(data, newline='')
         if self.import_type == 'native':
-            records = data.split('\n')
-            header_str = records.pop(0)
-            header = header_str.replace('"', '').split(',')
-            columns = header
+            records = self._iter_csv_rows(data)
+            header = next(records, [])
+            columns = list(header)
             model_fields = self.model_id.mapped('field_id.name')
             for idx, field in enumerate(header):
                 clean_field = field.split('/')[0]
                 if clean_field not in model_fields:
                     header[idx] = False
-            return {
+            res = {
                 'records': records,
                 'columns': columns,
                 'header': header,
             }
+            if self.key_column:
+                if self.key_column not in columns:
+                    raise ValidationError(_(
+                        'The key column %s is not in the spreadsheet.') % (
+                        self.key_column))
+                res['key_index'] = columns.index(self.key_column)
         if self.import_type == 'code':
-            return {
-                'records': [dict(rec) for rec in DictReader(StringIO(data))],
+            reader = csv.DictReader(data)
+            if self.key_column and self.key_column not in (
+                    reader.fieldnames or []):
+                raise ValidationError(_(
+                    'The key column %s is not in the spreadsheet.') % (
+                    self.key_column))
+            res = {
+                'records': (dict(rec) for rec in reader),
             }
+        key_getter = self._get_row_key_getter(res)
+        if key_getter:
+            res['row_stats'] = {}
+            res['fingerprints'] = {}
+            res['records'] = self._iter_changed_rows(
+                res['records'], key_getter, res['row_stats'],
+                res['fingerprints'])
+        if self.import_type == 'code' and self.stream_records:
+            # The rows are read while the code iterates them.
+            pass
+        elif self.import_type == 'code' and self.compact_records:
+            records = ColumnarRecords(reader.fieldnames)
+            records.extend(res['records'])
+            res['records'] = records
+        elif self.import_type == 'code':
+            res['records'] = list(res['records'])
+        return res
 
     def _process_code(self, data):
         for rec in self:
             records = data['records']
-            _logger.info(
-                'model %s importing %d rows...', self.model, len(records))
-            eval_context = self._get_eval_context(records)
-            safe_eval(
-                rec.code.strip(), eval_context, mode="exec", nocopy=True)
+            if (rec.compact_records and not rec.stream_records and
+                    isinstance(records, list)):
+                # Rows of the background chunks.
+                records = ColumnarRecords(
+                    records and list(records[0]) or [])
+                records.extend(data['records'])
+            stream = rec.stream_records or not isinstance(
+                records, (list, ColumnarRecords))
+            key_getter = rec._get_row_key_getter(data)
+            fingerprints = data.get('fingerprints', {})
+            stream_stats = {'rows': 0}
+            pending_keys = []
+            if stream:
+                _logger.info('model %s importing streamed rows...', self.model)
+                records = rec._iter_stream_records(
+                    records, stream_stats, key_getter,
+                    pending_keys if key_getter else None)
+            else:
+                _logger.info(
+                    'model %s importing %d rows...', self.model, len(records))
+            error_buffer = []
+            log_buffer = []
+            lookup_stats = {}
+
+            def save_fingerprints():
+                # The fingerprints of the rows iterated so far.
+                values = {
+                    key: fingerprints.pop(key) for key in pending_keys
+                    if key in fingerprints}
+                del pending_keys[:]
+                if not (eval_context.get('errors') or error_buffer):
+                    rec._save_row_fingerprints(values)
+
+            def save_checkpoint():
+                save_fingerprints()
+                if 'chunk_rows' in data:
+                    # Background import, the rows iterated so far are not
+                    # imported again if the worker fails before the end of
+                    # the batch.
+                    self.env['google.spreadsheet.chunk']._save_committed_rows(
+                        data['chunk_rows'], stream_stats['rows'])
+                    rec.write({
+                        'store_data': json.dumps(
+                            eval_context.get('store_data', {})),
+                    })
+
+            def lock_batch():
+                # The commit released the locks of the sheet and the batches,
+                # they are taken again so no other worker imports them.
+                if not (rec._lock_background_sheet() and
+                        rec._lock_background_chunks(data['chunk_ids'])):
+                    raise ValidationError(_(
+                        'The background import of %s was taken by another '
+                        'worker after commit().') % rec.name)
+            eval_context = self._get_eval_context(
+                records, error_buffer=error_buffer, log_buffer=log_buffer,
+                lookup_stats=lookup_stats,
+                on_commit=save_checkpoint if stream else None,
+                after_commit=lock_batch if 'chunk_ids' in data else None)
+            profiler = queries = None
+            if rec.profile_next_run:
+                profiler = cProfile.Profile()
+                queries = {}
+                query_hook = rec._get_profile_query_hook(queries)
+                thread = threading.current_thread()
+                if not hasattr(thread, 'query_hooks'):
+                    thread.query_hooks = []
+                thread.query_hooks.append(query_hook)
+                profiler.enable()
+            time_start = time.monotonic()
+            try:
+                rec._eval_code(eval_context)
+            finally:
+                if profiler:
+                    profiler.disable()
+                    thread.query_hooks.remove(query_hook)
+                rec._flush_logs(log_buffer)
+            batch_times = [time.monotonic() - time_start]
+            if stream:
+                save_fingerprints()
+            elif not (eval_context.get('errors') or error_buffer):
+                rec._save_row_fingerprints(fingerprints)
+            if error_buffer:
+                rec._save_errors(
+                    error_buffer, row_offset=data.get('row_offset', 0))
             return {
-                'errors': eval_context.get('errors', []),
+                'row_count': stream_stats['rows'] if stream else len(records),
+                'batch_times': batch_times,
+                # The errors of log_error also keep the next upload from
+                # being skipped.
+                'errors': eval_context.get('errors', []) + [
+                    error for error in error_buffer
+                    if error['type'] == 'error'],
                 'ids': eval_context.get('ids', ''),
+                'lookup_stats': lookup_stats,
+                'profile_report': profiler and rec._get_profile_report(
+                    profiler, queries),
                 'action': eval_context.get('action', {}),
-                'store_data': json.dumps(
-                    eval_context.get('store_data', {}), indent=2)
+                'store_data': json.dumps(eval_context.get('store_data', {})),
             }
 
+    @api.model
+    def _get_profile_query_hook(self, queries):
+        """ Returns a query hook of the cursor that adds the number of
+        executions and the seconds of each query to queries. """
+        def hook(cr, query, params, start, delay):
+            stats = queries.setdefault(str(query), [0, 0.0])
+            stats[0] += 1
+            stats[1] += delay
+        return hook
+
+    def _get_profile_report(self, profiler, queries):
+        """ Returns the text of the profile of a code import, with the
+        queries and the functions that took more time. """
+        self.ensure_one()
+        report = StringIO()
+        report.write('Profile of %s (%s)\n\n' % (self.name, self.id))
+        report.write(
+            'Queries by time: %d queries, %.3fs\n' % (
+                sum(count for count, dummy in queries.values()),
+                sum(delay for dummy, delay in queries.values())))
+        report.write('%10s %8s  %s\n' % ('seconds', 'count', 'query'))
+        for query, (count, delay) in sorted(
+                queries.items(), key=lambda item: -item[1][1])[
+                    :PROFILE_TOP_QUERIES]:
+            report.write('%10.3f %8d  %s\n' % (
+                delay, count, ' '.join(query.split())))
+        report.write('\nFunctions by cumulative time:\n')
+        pstats.Stats(profiler, stream=report).sort_stats(
+            'cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        return report.getvalue()
+
+    @api.model
+    def _iter_stream_records(
+            self, records, stats, key_getter=None, pending_keys=None):
+        """ Yields the rows of a streamed code import counting them.
+
+        :param pending_keys: list where the keys of the rows are kept until
+            their fingerprints are saved by commit or at the end of the
+            import
+        """
+        for row in records:
+            stats['rows'] += 1
+            if pending_keys is not None:
+                pending_keys.append(key_getter(row))
+            yield row
+
     def _process_native(self, data):
         for rec in self:
-            rec.error_ids.unlink()
-            records = data['records']
-            records = self._split_list(records, self.batch_size)
+            row_offset = data.get('row_offset', 0)
+            if not row_offset:
+                rec.error_ids.unlink()
+            records = iter(data['records'])
             header = data['header']
-            columns = data['columns']
-            base_import = self.env['base_import.import']
+            import_fields = [field for field in header if field]
+            if not import_fields:
+                raise ValidationError(_(
+                    'You must configure at least one field to import'))
             thousand = rec.float_thousand_separator
             decimal = rec.float_decimal_separator
             default_options = {
@@ -371,6 +1898,14 @@ class GoogleDriveSheet(models.Model):
                 'datetime_format': (
                     rec.datetime_format if rec.datetime_format else ''),
             }
+            coercers = []
+            if rec.prevalidate_rows:
+                coercers = rec._get_column_coercers(header)
+                # The dates are converted by _prevalidate_rows.
+                default_options.update({
+                    'date_format': tools.DEFAULT_SERVER_DATE_FORMAT,
+                    'datetime_format': tools.DEFAULT_SERVER_DATETIME_FORMAT,
+                })
             context = {}
             if rec.context:
                 try:
@@ -378,28 +1913,75 @@ class GoogleDriveSheet(models.Model):
                 except ValueError:
                     raise ValidationError(_(
                         'The context must be formatted as python dictionary.'))
+            # The rows are already parsed, so they are sent directly to
+            # load(). The importer is not saved, it is only used to convert
+            # dates and floats with the options of the sheet.
+            importer = self.env['base_import.import'].new({
+                'res_model': rec.model,
+            })
+            model = self.env[rec.model].with_context(
+                import_file=True, **context)
             errors = []
             ids = []
-            count = 0
-            for record in records:
-                new_import = base_import.create({
-                    'file': '\n'.join(record).encode('utf-8'),
-                    'res_model': rec.model,
-                    'file_name': 'google_export.csv',
-                    'file_type': 'text/csv; charset=utf-8',
-                })
-                do = new_import.with_context(**context).execute_import(
-                    header, columns, default_options)
+            batch_offset = 0
+            batch_size = rec._get_batch_size()
+            batch_sizes = []
+            batch_times = []
+            parse_time = 0.0
+            key_getter = rec._get_row_key_getter(data)
+            fingerprints = data.get('fingerprints', {})
+            positions = None
+
+            def get_row_num(index):
+                # We need to add 2 because Odoo return row number starting by
+                # 0 and we also need to add the header line to get the
+                # correct row number.
+                if positions is not None and 0 <= index < len(positions):
+                    index = positions[index]
+                return row_offset + batch_offset + 2 + index
+            while True:
+                time_start = time.monotonic()
+                record = list(islice(records, batch_size))
+                if not record:
+                    break
+                batch_sizes.append(len(record))
+                valid_rows = record
+                if rec.prevalidate_rows:
+                    valid_rows, positions, rejected = rec._prevalidate_rows(
+                        record, header, coercers)
+                    for position, field, value, message in rejected:
+                        row_num = row_offset + batch_offset + 2 + position
+                        errors.append({
+                            'type': 'error',
+                            'field': field.name,
+                            'field_name': field.string,
+                            'message': _('Invalid value for %s: %s') % (
+                                field.string, message),
+                            'value': value,
+                            'record': row_num,
+                            'row_from': row_num,
+                            'row_to': row_num,
+                        })
+                do = {}
+                try:
+                    input_data = valid_rows and importer._parse_import_data(
+                        rec._get_import_rows(valid_rows, header),
+                        import_fields, default_options)
+                except ImportValidationError as error:
+                    do = {'messages': [error.__dict__]}
+                    parse_time += time.monotonic() - time_start
+                else:
+                    load_start = time.monotonic()
+                    parse_time += load_start - time_start
+                    if input_data:
+                        do = model.load(import_fields, input_data)
+                        batch_times.append(time.monotonic() - load_start)
                 if do.get('messages'):
                     for error in do.get('messages'):
-                        error['sheet_id'] = rec.id
-                        # We need to add 2 because Odoo return row number
-                        # starting by 0 and we also need to add the header
-                        # line to get the correct row number.
-                        row_num = count * rec.batch_size + 2
                         if error.get('rows'):
-                            error['row_from'] = error['rows']['from'] + row_num
-                            error['row_to'] = error['rows']['to'] + row_num
+                            error['row_from'] = get_row_num(
+                                error['rows']['from'])
+                            error['row_to'] = get_row_num(error['rows']['to'])
                             error.pop('rows')
                         if error.get('moreinfo'):
                             error.pop('moreinfo')
@@ -408,18 +1990,42 @@ class GoogleDriveSheet(models.Model):
                         if error.get('field_type'):
                             error.pop('field_type')
                         if error.get('record', False):
-                            error['record'] = error['record'] + row_num
+                            error['record'] = get_row_num(error['record'])
                         errors.append(error)
                 if do.get('ids'):
                     ids.extend(do.get('ids'))
-                count += 1
+                if key_getter:
+                    # The fingerprints of the original values, without the
+                    # rejected rows.
+                    valid = set(
+                        range(len(record)) if positions is None
+                        else positions)
+                    values = {}
+                    for position, row in enumerate(record):
+                        key = key_getter(row)
+                        fingerprint = fingerprints.pop(key, None)
+                        if fingerprint and position in valid:
+                            values[key] = fingerprint
+                    if not any(
+                            message.get('type') == 'error'
+                            for message in do.get('messages', [])):
+                        rec._save_row_fingerprints(values)
+                batch_offset += len(record)
+                if rec.adaptive_batch:
+                    batch_size = rec._get_adaptive_batch_size(
+                        batch_size, len(record),
+                        time.monotonic() - time_start)
             if errors:
-                rec.error_ids.create(errors)
+                rec._save_errors(errors, row_offset=row_offset)
             # TODO Create a wizard to check if have combined stuff
             # errors and ids
             return {
                 'errors': errors,
                 'ids': ids,
+                'batch_sizes': batch_sizes,
+                'batch_times': batch_times,
+                'parse_time': parse_time,
+                'next_batch_size': batch_size,
                 'action': {
                     'name': rec.model_id.display_name,
                     'type': 'ir.actions.act_window',
@@ -454,6 +2060,98 @@ class GoogleDriveSheetError(models.Model):
     value = fields.Char(readonly=True)
 
 
+class GoogleDriveSheetChunk(models.Model):
+    _name = 'google.spreadsheet.chunk'
+    _description = 'Batches of Google Drive Sheets background import'
+    _order = 'sheet_id, sequence'
+
+    sheet_id = fields.Many2one(
+        'google.spreadsheet', readonly=True, required=True,
+        ondelete='cascade')
+    sequence = fields.Integer(readonly=True)
+    row_offset = fields.Integer(
+        readonly=True,
+        help='Position of the first row of this batch in the spreadsheet, '
+        'without the header.')
+    row_count = fields.Integer(readonly=True)
+    committed_row_count = fields.Integer(
+        readonly=True,
+        help='Rows of this batch already committed by commit() in a streamed '
+        'code import, they are skipped when the batch is imported again.')
+    data = fields.Text(
+        readonly=True,
+        help='Technical field used to save the rows of this batch.')
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done')], default='pending', required=True, readonly=True)
+
+    def init(self):
+        tools.create_index(
+            self._cr, 'google_spreadsheet_chunk_sheet_state_sequence_index',
+            self._table, ['sheet_id', 'state', 'sequence'])
+
+    def _get_data(self):
+        """ Rebuilds the structure returned by _process_data using the
+        header saved in the sheet and the rows of these consecutive batches
+        of the same sheet. """
+        chunks = self.sorted('sequence')
+        data = json.loads(chunks[:1].sheet_id.data or '{}')
+        data['records'] = []
+        data['row_offset'] = chunks[:1].row_offset
+        data['chunk_ids'] = chunks.ids
+        data['chunk_rows'] = []
+        for chunk in chunks:
+            # Rows already committed by a streamed code import that failed
+            # before the end of the batch.
+            skip = chunk.committed_row_count
+            if not data['records']:
+                data['row_offset'] = chunk.row_offset + skip
+            data['records'].extend(json.loads(chunk.data)[skip:])
+            data['chunk_rows'].append((chunk.id, skip, chunk.row_count))
+        key_getter = chunks[:1].sheet_id._get_row_key_getter(data)
+        if key_getter:
+            # Calculated before the code can change the rows.
+            data['fingerprints'] = chunks[:1].sheet_id._get_row_fingerprints(
+                data['records'], key_getter)
+        return data
+
+    @api.model
+    def _save_committed_rows(self, chunk_rows, rows):
+        """ Saves in each batch its rows committed by a streamed code import.
+
+        :param chunk_rows: list of tuples (id, committed rows, rows) of the
+            batches when they were claimed, see _get_data
+        :param rows: rows committed since the batches were claimed, they are
+            the first rows not committed of the batches in that order
+        """
+        for chunk_id, committed, row_count in chunk_rows:
+            if rows <= 0:
+                break
+            count = min(rows, row_count - committed)
+            if count > 0:
+                self.browse(chunk_id).write({
+                    'committed_row_count': committed + count,
+                })
+                rows -= count
+
+
+class GoogleDriveSheetRow(models.Model):
+    _name = 'google.spreadsheet.row'
+    _description = 'Fingerprints of the rows imported from Google Drive Sheets'
+    _log_access = False
+
+    sheet_id = fields.Many2one(
+        'google.spreadsheet', readonly=True, required=True,
+        ondelete='cascade')
+    key = fields.Char(readonly=True, required=True)
+    fingerprint = fields.Char(readonly=True)
+
+    _sql_constraints = [
+        ('sheet_key_uniq', 'unique(sheet_id, key)',
+         'The key of the row must be unique per sheet.'),
+    ]
+
+
 class GoogleDriveSheetLog(models.Model):
     _name = 'google.spreadsheet.log'
     _description = 'Log of Google Drive Sheets'
@@ -463,6 +2161,64 @@ class GoogleDriveSheetLog(models.Model):
         'google.spreadsheet', readonly=True, ondelete='cascade')
     name = fields.Char(readonly=True)
     duration = fields.Char(readonly=True)
+    batch_sizes = fields.Char(
+        readonly=True,
+        help='Sizes of the batches used in this import.')
+    lookup_hits = fields.Integer(
+        readonly=True,
+        help='Values found in the cache of lookup() in code imports.')
+    lookup_misses = fields.Integer(
+        readonly=True,
+        help='Values searched in the database by lookup() in code imports.')
+    retry_count = fields.Integer(
+        string='Retries', readonly=True,
+        help='Requests to Google retried because of the quota or server '
+        'errors while downloading the sheet.')
+    retry_wait = fields.Float(
+        string='Retry wait (s)', readonly=True,
+        help='Seconds waited for the rate limit and the retries while '
+        'downloading the sheet.')
+    fetch_time = fields.Float(
+        string='Fetch time (s)', readonly=True, group_operator='avg',
+        help='Seconds spent downloading the sheet, including the retries. '
+        'The sheets downloaded with the same request of the Sheets API share '
+        'the time and the size.')
+    fetch_bytes = fields.Integer(
+        string='Bytes downloaded', readonly=True,
+        help='Size of the content downloaded, the background batches do not '
+        'download anything.')
+    parse_time = fields.Float(
+        string='Parse time (s)', readonly=True, group_operator='avg',
+        help='Seconds spent reading the CSV and converting the rows for the '
+        'import. In streamed code imports the rows are read by the code, so '
+        'that time is part of the ORM time.')
+    process_time = fields.Float(
+        string='Process time (s)', readonly=True, group_operator='avg',
+        help='Seconds spent importing the rows, it is the same as the '
+        'duration.')
+    row_count = fields.Integer(string='Rows', readonly=True)
+    rows_per_second = fields.Float(
+        string='Rows/sec', readonly=True, group_operator='avg')
+    orm_time_p50 = fields.Float(
+        string='Batch ORM time p50 (s)', readonly=True, group_operator='avg',
+        help='Median of the seconds spent by the ORM in each batch, the code '
+        'of code imports counts as a single batch.')
+    orm_time_p95 = fields.Float(
+        string='Batch ORM time p95 (s)', readonly=True, group_operator='avg')
+    orm_time_max = fields.Float(
+        string='Batch ORM time max (s)', readonly=True, group_operator='max')
+    query_count = fields.Integer(
+        string='SQL queries', readonly=True,
+        help='Queries executed by the cursor of the import.')
+    profile_report = fields.Binary(
+        readonly=True, attachment=True,
+        help='Profile of the code and the SQL queries of this import.')
+    profile_report_name = fields.Char(readonly=True)
+    memory_peak_delta = fields.Integer(
+        string='Peak memory increase (KB)', readonly=True,
+        group_operator='max',
+        help='Increase of the peak resident memory of the process during '
+        'the import. It is 0 when the peak was reached before.')
     ids_related = fields.Char(
         readonly=True,
         help='Technical field used to save the ids of the records that was '
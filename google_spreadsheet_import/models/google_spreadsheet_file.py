@@ -5,16 +5,26 @@
 import logging
 import re
 import string
+import threading
+import time
 
-from googleapiclient import discovery
 from googleapiclient.errors import HttpError
-import google.oauth2.credentials
+import requests
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError
 
+from . import google_client
+
 _logger = logging.getLogger(__name__)
 logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
 
+# Google access tokens last one hour, they are renewed some minutes before.
+ACCESS_TOKEN_LIFETIME = 50 * 60
+
+# Access tokens by database and credentials, shared by all the threads.
+_access_tokens = {}
+_access_tokens_lock = threading.Lock()
+
 
 class GoogleDriveFile(models.Model):
     _name = 'google.spreadsheet.file'
@@ -46,11 +56,66 @@ class GoogleDriveFile(models.Model):
         string='Models')
 
     @api.model
-    def _get_service(self):
+    def _get_access_token_key(self):
+        config = self.env['ir.config_parameter'].sudo()
+        return (
+            self._cr.dbname,
+            config.get_param('google_drive_client_id'),
+            config.get_param('google_drive_refresh_token'),
+        )
+
+    @api.model
+    def _get_access_token(self):
+        """ Returns the Google Drive access token, it is requested again only
+        when it is about to expire or the credentials change. """
+        key = self._get_access_token_key()
+        with _access_tokens_lock:
+            access_token, expiration = _access_tokens.get(key, (None, 0))
+        if access_token and expiration > time.monotonic():
+            return access_token
         access_token = self.env['google.drive.config'].get_access_token()
-        credentials = google.oauth2.credentials.Credentials(access_token)
-        return discovery.build(
-            'sheets', 'v4', credentials=credentials)
+        with _access_tokens_lock:
+            _access_tokens[key] = (
+                access_token, time.monotonic() + ACCESS_TOKEN_LIFETIME)
+        return access_token
+
+    @api.model
+    def _clear_access_token(self):
+        """ Forgets the cached access token, used when Google rejects it. """
+        with _access_tokens_lock:
+            _access_tokens.pop(self._get_access_token_key(), None)
+
+    @api.model
+    def _get_service(self):
+        return google_client.get_sheets_service(self._get_access_token())
+
+    def _get_drive_metadata(self):
+        """ Returns the version and modifiedTime of the file from the Google
+        Drive API, the version increases every time the file is modified.
+        Returns an empty dictionary if they can not be obtained. """
+        self.ensure_one()
+        access_token = self._get_access_token()
+        try:
+            response = google_client.call(
+                lambda: google_client.get_http_session().get(
+                    google_client.DRIVE_FILES_URL % self.id_file,
+                    params={'fields': 'version,modifiedTime'},
+                    headers={'Authorization': 'Bearer %s' % access_token},
+                    timeout=30),
+                id_file=self.id_file)
+        except requests.RequestException as error:
+            _logger.warning(
+                'Unable to get the revision of the file %s: %s',
+                self.id_file, error)
+            return {}
+        if response.status_code in (401, 403):
+            self._clear_access_token()
+        if response.status_code != 200:
+            _logger.warning(
+                'Unable to get the revision of the file %s: HTTP %s',
+                self.id_file, response.status_code)
+            return {}
+        return response.json()
 
     @api.model
     def _extract_id_from_url(self, url):
@@ -66,8 +131,10 @@ class GoogleDriveFile(models.Model):
         for rec in self:
             service = rec._get_service()
             try:
-                sheet_metadata = service.spreadsheets().get(
-                    spreadsheetId=self.id_file).execute()
+                sheet_metadata = google_client.call(
+                    service.spreadsheets().get(
+                        spreadsheetId=rec.id_file).execute,
+                    id_file=rec.id_file)
             except HttpError:
                 raise UserError(_(
                     'The Spreadsheet ID is not correct, please verify it.'))
@@ -192,14 +259,21 @@ class GoogleDriveFile(models.Model):
                 })
                 sheet_id += 1
             service = rec._get_service()
-            sheet_metadata = service.spreadsheets().create(
-                body=spreadsheet).execute()
-            service.spreadsheets().values().batchUpdate(
-                spreadsheetId=sheet_metadata.get('spreadsheetId'),
-                body=sheets_data).execute()
-            service.spreadsheets().batchUpdate(
-                spreadsheetId=sheet_metadata.get('spreadsheetId'),
-                body={'requests': requests}).execute()
+            # Only the requests rejected by the quota are retried, a server
+            # error could have created the spreadsheet anyway.
+            sheet_metadata = google_client.call(
+                service.spreadsheets().create(body=spreadsheet).execute,
+                retry_status=(429,))
+            id_file = sheet_metadata.get('spreadsheetId')
+            google_client.call(
+                service.spreadsheets().values().batchUpdate(
+                    spreadsheetId=id_file, body=sheets_data).execute,
+                id_file=id_file)
+            google_client.call(
+                service.spreadsheets().batchUpdate(
+                    spreadsheetId=id_file,
+                    body={'requests': requests}).execute,
+                id_file=id_file)
             vals = rec._get_file_info(sheet_metadata)
             rec.write(vals)
 
@@ -0,0 +1,59 @@
+# Copyright 2019, Jarsa Sistemas, S.A. de C.V.
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+from odoo.tests.common import TransactionCase
+
+
+class TestPrevalidateRows(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        spreadsheet_file = self.env['google.spreadsheet.file'].create({
+            'name': 'Test',
+            'id_file': 'test',
+        })
+        self.sheet = self.env['google.spreadsheet'].create({
+            'name': 'Partners',
+            'model_id': self.env['ir.model']._get_id('res.partner'),
+            'file_id': spreadsheet_file.id,
+            'date_format': '%d-%m-%Y',
+        })
+
+    def test_external_id_column(self):
+        header = ['id', 'name']
+        self.assertIsNone(self.sheet._get_header_field('id'))
+        self.assertFalse(self.sheet._get_column_coercers(header))
+        rows = [
+            ['__import__.partner_1', 'Partner 1'],
+            ['__import__.partner_2', 'Partner 2'],
+        ]
+        valid, positions, rejected = self.sheet._prevalidate_rows(
+            rows, header, self.sheet._get_column_coercers(header))
+        self.assertEqual(valid, rows)
+        self.assertEqual(positions, [0, 1])
+        self.assertFalse(rejected)
+
+    def test_many2one_external_id_column(self):
+        header = ['name', 'parent_id/id', 'parent_id/.id']
+        self.assertIsNone(self.sheet._get_header_field('parent_id/id'))
+        self.assertIsNone(self.sheet._get_header_field('parent_id/.id'))
+        self.assertFalse(self.sheet._get_column_coercers(header))
+        rows = [['Partner 1', 'base.main_partner', '1']]
+        valid, dummy, rejected = self.sheet._prevalidate_rows(
+            rows, header, self.sheet._get_column_coercers(header))
+        self.assertEqual(valid, rows)
+        self.assertFalse(rejected)
+
+    def test_invalid_date_rejected(self):
+        header = ['id', 'name', 'date']
+        rows = [
+            ['__import__.partner_1', 'Partner 1', '31-01-2020'],
+            ['__import__.partner_2', 'Partner 2', '2020/01/31'],
+        ]
+        valid, positions, rejected = self.sheet._prevalidate_rows(
+            rows, header, self.sheet._get_column_coercers(header))
+        self.assertEqual(
+            valid, [['__import__.partner_1', 'Partner 1', '2020-01-31']])
+        self.assertEqual(positions, [0])
+        self.assertEqual(len(rejected), 1)
+        self.assertEqual(rejected[0][0], 1)